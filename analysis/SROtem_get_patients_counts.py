@@ -1,22 +1,39 @@
-import pandas as pd
-import os
+import argparse
 import json
-import numpy as np
-
-
-patients_total = {}
-for file in os.listdir('output'):
-
-        if file.startswith('input_measures_bycode_2'):
-            date = file.split('_')[-1][:-4]
-
-            df = pd.read_csv(os.path.join('output', file))
-            
-            patients = np.unique(df['patient_id'][df['event_x']==1])
-
-            patients_total[date] =[int(x) for x in patients]
-
-
+import os
 
-with open('output/patient_count.json', 'w') as f:
-    json.dump({"num_patients": patients_total}, f)
+from patient_counts import (
+    INPUT_DIR,
+    STORE_DIR,
+    list_monthly_inputs,
+    scan_dtype,
+    scan_inputs,
+    update_store,
+)
+from schema import load_schema
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input-dir', default=INPUT_DIR,
+                        help='the monthly cohort files, or a date-partitioned dataset written by columnar.py')
+    parser.add_argument('--incremental', action='store_true',
+                        help=f'only parse new or changed months, storing ids as binary arrays in {STORE_DIR}')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='number of processes used to scan the monthly files')
+    parser.add_argument('--study-definition',
+                        help='read the monthly files with the dtypes this study definition declares')
+    args = parser.parse_args()
+    dtype = scan_dtype(load_schema(args.study_definition) if args.study_definition else None)
+
+    if args.incremental:
+        rebuilt = update_store(args.input_dir, STORE_DIR, workers=args.workers, dtype=dtype)
+        print(f'rebuilt {len(rebuilt)} month(s): {", ".join(rebuilt)}')
+
+    else:
+        patients_total = {}
+        for date, patients in scan_inputs(list_monthly_inputs(args.input_dir), args.workers, dtype=dtype).items():
+            patients_total[date] = [int(x) for x in patients]
+
+        with open('output/patient_count.json', 'w') as f:
+            json.dump({"num_patients": patients_total}, f)
@@ -0,0 +1,180 @@
+import argparse
+import glob
+import importlib
+import os
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from expressions import compile_expression
+
+
+# the categorised_as definitions of study_definition_measures_sro.py
+AGE_BANDS = {
+    "0": "DEFAULT",
+    "0-19": """ age >= 0 AND age < 20""",
+    "20-29": """ age >=  20 AND age < 30""",
+    "30-39": """ age >=  30 AND age < 40""",
+    "40-49": """ age >=  40 AND age < 50""",
+    "50-59": """ age >=  50 AND age < 60""",
+    "60-69": """ age >=  60 AND age < 70""",
+    "70-79": """ age >=  70 AND age < 80""",
+    "80+": """ age >=  80 AND age < 120""",
+}
+IMD_QUINTILES = {
+    "0": "DEFAULT",
+    "1": """index_of_multiple_deprivation >=1 AND index_of_multiple_deprivation < 32844*1/5""",
+    "2": """index_of_multiple_deprivation >= 32844*1/5 AND index_of_multiple_deprivation < 32844*2/5""",
+    "3": """index_of_multiple_deprivation >= 32844*2/5 AND index_of_multiple_deprivation < 32844*3/5""",
+    "4": """index_of_multiple_deprivation >= 32844*3/5 AND index_of_multiple_deprivation < 32844*4/5""",
+    "5": """index_of_multiple_deprivation >= 32844*4/5 AND index_of_multiple_deprivation < 32844""",
+}
+BANDINGS = {'age_band': AGE_BANDS, 'imd': IMD_QUINTILES}
+
+# `lower`/`upper` bounds per label (-inf/inf when absent), and whether each
+# is inclusive; `default` is the DEFAULT label
+Bands = namedtuple('Bands', ['variable', 'labels', 'lower', 'lower_closed',
+                             'upper', 'upper_closed', 'default'])
+
+FLIPPED = {'<': '>', '>': '<', '<=': '>=', '>=': '<='}
+
+
+def _terms(node):
+    # the comparisons of a condition joined by AND, in order
+    if node[0] == 'and':
+        return _terms(node[1]) + _terms(node[2])
+    return [node]
+
+
+def _bound(term, label, condition):
+    """(variable, side, value, closed) of one `x >= a` style comparison, as
+    parsed by expressions.py (constant arithmetic is already folded).
+    """
+    if term[0] == 'compare' and term[1] in FLIPPED:
+        op, left, right = term[1:]
+        if left[0] == 'constant' and right[0] == 'column':
+            op, left, right = FLIPPED[op], right, left
+        if left[0] == 'column' and right[0] == 'constant' and isinstance(right[1], (int, float)):
+            side = 'lower' if op.startswith('>') else 'upper'
+            return left[1], side, right[1], op.endswith('=')
+    raise ValueError(f'{label!r}: not an interval condition: {condition!r}')
+
+
+def parse_bands(categories):
+    """Parses a categorised_as dict whose conditions are intervals of one
+    variable (`x >= a AND x < b`, either bound optional) into Bands, from the
+    expression trees of expressions.py.
+    Raises ValueError for anything else, or for overlapping intervals.
+    """
+    variable, default = None, None
+    labels, lower, lower_closed, upper, upper_closed = [], [], [], [], []
+    for label, condition in categories.items():
+        if condition.strip() == 'DEFAULT':
+            default = str(label)
+            continue
+        bounds = {'lower': (-np.inf, False), 'upper': (np.inf, False)}
+        for term in _terms(compile_expression(condition).tree):
+            name, side, value, closed = _bound(term, label, condition)
+            if variable not in (None, name):
+                raise ValueError(f'{label!r}: conditions on both {variable} and {name}')
+            variable = name
+            bounds[side] = (value, closed)
+        labels.append(str(label))
+        lower.append(bounds['lower'][0])
+        lower_closed.append(bounds['lower'][1])
+        upper.append(bounds['upper'][0])
+        upper_closed.append(bounds['upper'][1])
+
+    order = np.argsort(lower, kind='stable')
+    bands = Bands(variable, [labels[i] for i in order], np.array(lower)[order],
+                  np.array(lower_closed)[order], np.array(upper)[order],
+                  np.array(upper_closed)[order], default)
+    overlapping = (bands.upper[:-1] > bands.lower[1:]) | (
+        (bands.upper[:-1] == bands.lower[1:]) & bands.upper_closed[:-1] & bands.lower_closed[1:])
+    if overlapping.any():
+        raise ValueError(f'overlapping bands: {bands.labels}')
+    return bands
+
+
+def categorise(values, bands, categories=None):
+    """Labels `values` with `bands`, as categorised_as would: one
+    searchsorted over the sorted lower bounds, then a check of both bounds
+    of the candidate band (and of the one before it, for open lower bounds).
+    Values in no band, and missing values, get the DEFAULT label.
+    Returns a Categorical with the labels in `categories` order (the
+    definition's order by default).
+    """
+    values = np.asarray(values, dtype=float)
+    codes = np.full(len(values), -1, dtype=np.int64)
+    candidate = np.searchsorted(bands.lower, values, side='right') - 1
+    for step in (0, 1) if bands.labels else ():
+        i = candidate - step
+        safe = np.maximum(i, 0)
+        above = np.where(bands.lower_closed[safe], values >= bands.lower[safe], values > bands.lower[safe])
+        below = np.where(bands.upper_closed[safe], values <= bands.upper[safe], values < bands.upper[safe])
+        codes = np.where((codes < 0) & (i >= 0) & above & below, safe, codes)
+
+    if categories is None:
+        categories = bands.labels + ([bands.default] if bands.default is not None else [])
+    categories = list(categories)
+    # band (and default, last) -> position in `categories`, -1 for missing
+    position = np.array([categories.index(label) if label in categories else -1
+                         for label in bands.labels + [bands.default]], dtype=np.int64)
+    return pd.Categorical.from_codes(position[np.where(codes < 0, len(bands.labels), codes)],
+                                     categories=categories)
+
+
+def categorise_frame(df, bandings=BANDINGS):
+    """Adds (or replaces) a column per {column: categorised_as dict} of
+    `bandings`, from the raw variable each definition is written in terms of
+    (e.g. `age`, `index_of_multiple_deprivation`), keeping the label order
+    of the definition.
+    """
+    for column, categories in bandings.items():
+        bands = parse_bands(categories)
+        df[column] = categorise(df[bands.variable].to_numpy(dtype=float), bands,
+                                [str(c) for c in categories])
+    return df
+
+
+def study_bandings(study_name, columns=None):
+    """{column: categorised_as dict} for the interval categorisations of a
+    study definition (`columns`, or all that parse). Needs cohortextractor.
+    """
+    definitions = importlib.import_module(study_name).study.covariate_definitions
+    bandings = {}
+    for name, (funcname, kwargs) in definitions.items():
+        if funcname != 'categorised_as' or (columns is not None and name not in columns):
+            continue
+        try:
+            parse_bands(kwargs['categories'])
+        except ValueError:
+            if columns is not None:
+                raise
+            continue
+        bandings[name] = kwargs['categories']
+    return bandings
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Re-band age and IMD (or other interval categorised_as variables) in cohort files')
+    parser.add_argument('--input-files', default='output/measures/input_*.csv')
+    parser.add_argument('--output-dir', default=os.path.join('output', 'rebanded'),
+                        help='where to write re-banded files, kept apart from the raw inputs')
+    parser.add_argument('--study-definition',
+                        help='take band definitions from this study definition instead of the defaults')
+    args = parser.parse_args()
+
+    bandings = study_bandings(args.study_definition) if args.study_definition else BANDINGS
+    for path in sorted(glob.glob(args.input_files)):
+        df = pd.read_csv(path, keep_default_na=False, na_values={
+            parse_bands(c).variable: [''] for c in bandings.values()})
+        present = {k: v for k, v in bandings.items() if parse_bands(v).variable in df.columns}
+        categorise_frame(df, present)
+        output_path = os.path.join(args.output_dir, os.path.basename(path))
+        if os.path.abspath(output_path) == os.path.abspath(path):
+            parser.error(f'--output-dir would overwrite {path}')
+        os.makedirs(args.output_dir, exist_ok=True)
+        df.to_csv(output_path, index=False)
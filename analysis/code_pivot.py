@@ -0,0 +1,114 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from event_table import CALENDARS, EVENT_TABLE, count_matrix, period_frames, read_events, write_period_files
+
+
+CODELIST_DIR = 'codelists-local'
+
+# the codelists of codelists.py, under the variable names the study
+# definitions count them as
+CODELIST_GROUPS = {
+    'OC_OC10': ('onlineconsultation_qds_ctv3.csv', 'CTV3Code'),
+    'OC_Y1f3b': ('onlineconsultation_Y1f3b_ctv3.csv', 'CTV3Code'),
+    'OC_XUkjp': ('onlineconsultation_XUkjp_ctv3.csv', 'CTV3Code'),
+    'OC_XaXcK': ('onlineconsultation_XaXcK_ctv3.csv', 'CTV3Code'),
+    'OC_XVCTw': ('onlineconsultation_XVCTw_ctv3.csv', 'CTV3Code'),
+    'OC_XUuWQ': ('onlineconsultation_XUuWQ_ctv3.csv', 'CTV3Code'),
+    'OC_XV1pT': ('onlineconsultation_XV1pT_ctv3.csv', 'CTV3Code'),
+    'OC_computerlink': ('onlineconsultation_computerlink_ctv3.csv', 'CTV3Code'),
+    'OC_alertreceived': ('onlineconsultation_alertreceived_ctv3.csv', 'CTV3Code'),
+    'OC_Y22b4': ('onlineconsultation_Y22b4_ctv3.csv', 'CTV3Code'),
+    'snomed_OCall': ('martinaf-online-consultations-snomed-v01-28bba9bc.csv', 'code'),
+}
+# codes also counted one by one, as loop_over_codes(oc_local_codes_snomed)
+PER_CODE_GROUP = 'snomed_OCall'
+PER_CODE_PREFIX = 'snomed_'
+
+
+def read_codelist(path, column):
+    codes = pd.read_csv(path, usecols=[column], dtype=str, encoding='utf-8-sig')[column]
+    return sorted(set(codes.dropna().str.strip()))
+
+
+def load_groups(codelist_dir=CODELIST_DIR, groups=CODELIST_GROUPS):
+    """Returns {group name: codes} for the codelist csvs of `groups`.
+    """
+    return {name: read_codelist(os.path.join(codelist_dir, file), column)
+            for name, (file, column) in groups.items()}
+
+
+class MembershipIndex:
+    """Code -> group membership as a codes x groups 0/1 matrix, with codes
+    sorted so that they can be looked up with searchsorted. A code may be
+    in any number of groups.
+    """
+
+    def __init__(self, codes, groups, matrix):
+        self.codes = np.asarray(codes, dtype=str)
+        self.groups = list(groups)
+        self.matrix = matrix
+
+    @classmethod
+    def from_groups(cls, groups):
+        codes = np.array(sorted({str(c) for members in groups.values() for c in members}), dtype=str)
+        matrix = np.zeros((len(codes), len(groups)), dtype=np.int64)
+        for j, members in enumerate(groups.values()):
+            matrix[np.searchsorted(codes, [str(c) for c in members]), j] = 1
+        return cls(codes, groups, matrix)
+
+    def code_positions(self, codes):
+        codes = np.asarray(codes, dtype=str)
+        positions = np.searchsorted(self.codes, codes)
+        found = positions < len(self.codes)
+        found[found] = self.codes[positions[found]] == codes[found]
+        if not found.all():
+            raise KeyError(f'codes not in any group: {list(codes[~found])}')
+        return positions
+
+    def groups_of(self, code):
+        return [self.groups[j] for j in np.flatnonzero(self.matrix[self.code_positions([code])[0]])]
+
+    def group_counts(self, counts):
+        """Rows x groups counts from rows x codes counts.
+        """
+        return counts @ self.matrix
+
+
+def pivot_events(events, index, calendar='month', per_code=None, prefix=PER_CODE_PREFIX):
+    """Each patient's matches per period for every group of `index`, and for
+    each of the `per_code` codes on its own (as `<prefix><code>`), from one
+    pass over the events. Returns {period start: frame}, as count_events.
+    """
+    per_code = [] if per_code is None else [str(c) for c in per_code]
+    periods, patient_ids, bounds, counts = count_matrix(events, calendar, list(index.codes))
+    counts = np.hstack((counts[:, index.code_positions(per_code)], index.group_counts(counts)))
+    columns = [f'{prefix}{c}' for c in per_code] + index.groups
+    return period_frames(periods, patient_ids, bounds, counts, columns)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Count matches of every code and codelist per patient and period from the event table')
+    parser.add_argument('--event-table', default=EVENT_TABLE)
+    parser.add_argument('--codelist-dir', default=CODELIST_DIR)
+    parser.add_argument('--calendar', choices=CALENDARS, default='month')
+    parser.add_argument('--start-date')
+    parser.add_argument('--end-date')
+    parser.add_argument('--output-dir', default=os.path.join('output', 'events'))
+    parser.add_argument('--name', default='bycode')
+    parser.add_argument('--snapshot-dir',
+                        help='join each period onto its population from the patient snapshot')
+    args = parser.parse_args()
+
+    groups = load_groups(args.codelist_dir)
+    index = MembershipIndex.from_groups(groups)
+    events = read_events(args.event_table, args.start_date, args.end_date, codes=index.codes)
+    results = pivot_events(events, index, args.calendar, per_code=groups[PER_CODE_GROUP])
+    if args.snapshot_dir:
+        from patient_snapshot import PatientSnapshot, join_periods
+        results = join_periods(PatientSnapshot.load(args.snapshot_dir), results)
+    write_period_files(results, args.output_dir, f'{args.name}_{args.calendar}')
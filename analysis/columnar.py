@@ -0,0 +1,153 @@
+import argparse
+import glob
+import os
+import re
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+
+OUTPUT_DIR = 'output'
+COLUMNAR_DIR = os.path.join(OUTPUT_DIR, 'columnar')
+# low-cardinality columns stored dictionary-encoded
+DICTIONARY_COLUMNS = ['region', 'sex', 'age_band', 'imd', 'ethnicity', 'stp']
+COMPRESSION = 'zstd'
+ROW_GROUP_SIZE = 250_000
+
+DATED_INPUT = re.compile(r'^(input_\w*?)_(\d{4}-\d{2}-\d{2})\.csv$')
+PARTITION = re.compile(r'^date=(\d{4}-\d{2}-\d{2})$')
+PARTITIONING = ds.partitioning(pa.schema([('date', pa.string())]), flavor='hive')
+
+
+def _read_csv(path):
+    # dictionary columns are read as strings, so codes such as imd "1" keep
+    # their labels, and encoded on write; dates stay 'YYYY-MM-DD' text, as
+    # in the partition keys, so date filters compare alike everywhere
+    header = pd.read_csv(path, nrows=0).columns
+    types = {c: pa.string() for c in DICTIONARY_COLUMNS + ['date'] if c in header}
+    return pv.read_csv(path, convert_options=pv.ConvertOptions(column_types=types))
+
+
+def _encode(table):
+    for c in DICTIONARY_COLUMNS:
+        if c in table.column_names:
+            i = table.column_names.index(c)
+            table = table.set_column(i, c, table.column(c).dictionary_encode())
+    return table
+
+
+def write_table(table, path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    pq.write_table(_encode(table), path, compression=COMPRESSION,
+                   row_group_size=ROW_GROUP_SIZE, write_statistics=True)
+
+
+def convert_csv(path, columnar_dir=COLUMNAR_DIR, root=OUTPUT_DIR):
+    """Converts one csv output to parquet, mirroring its place under `root`.
+    Monthly and weekly cohort files (`input_<name>_<date>.csv`) go to the
+    date partition of the `input_<name>` dataset; any other file
+    (`input_ori.csv`, `measure_*.csv`) becomes a single parquet file, sorted
+    by date where it has one so that row-group statistics can skip dates.
+    Returns the path written.
+    """
+    file = os.path.basename(path)
+    target_dir = os.path.normpath(os.path.join(columnar_dir, os.path.relpath(os.path.dirname(path), root)))
+    table = _read_csv(path)
+    match = DATED_INPUT.match(file)
+    if match:
+        name, date = match.groups()
+        target = os.path.join(target_dir, name, f'date={date}', 'part-0.parquet')
+    else:
+        if 'date' in table.column_names:
+            table = table.sort_by('date')
+        target = os.path.join(target_dir, file[:-len('.csv')] + '.parquet')
+    write_table(table, target)
+    return target
+
+
+def list_partitions(dataset_dir):
+    """Returns {date: path} of the partition files of a dataset, sorted by date.
+    """
+    partitions = {}
+    for entry in os.listdir(dataset_dir):
+        match = PARTITION.match(entry)
+        if match:
+            partitions[match.group(1)] = os.path.join(dataset_dir, entry, 'part-0.parquet')
+    return dict(sorted(partitions.items()))
+
+
+def _and(expression, term):
+    return term if expression is None else expression & term
+
+
+def _scan(path, columns=None, start_date=None, end_date=None, filter=None):
+    # the arrow table of a parquet file or dataset, with the projection and
+    # filters pushed down to the scanner
+    partitioning = PARTITIONING if os.path.isdir(path) else None
+    dataset = ds.dataset(path, format='parquet', partitioning=partitioning)
+    expression = filter
+    if start_date is not None:
+        expression = _and(expression, ds.field('date') >= start_date)
+    if end_date is not None:
+        expression = _and(expression, ds.field('date') <= end_date)
+    return dataset.to_table(columns=columns, filter=expression)
+
+
+def read_table(path, columns=None, start_date=None, end_date=None, filter=None):
+    """Reads a parquet file or date-partitioned dataset into pandas, pushing
+    the column projection and any date range (inclusive, 'YYYY-MM-DD') down
+    to the files so that skipped partitions and row groups are never read.
+    """
+    return _scan(path, columns, start_date, end_date, filter).to_pandas()
+
+
+def read_columns(path, columns, dtype=None, start_date=None, end_date=None):
+    """Reads `columns` of a csv or parquet file into pandas, as
+    `pd.read_csv(path, usecols=columns, dtype=dtype, keep_default_na=False)`
+    would: category columns hold text labels, with '' for missing; blanks in
+    other columns are missing values. Parquet is read through the same
+    scanner as `read_table`, so a date range is pushed down with the
+    projection.
+    """
+    dtype = dtype or {}
+    if not path.endswith('.parquet') and not os.path.isdir(path):
+        return pd.read_csv(path, usecols=columns, dtype=dtype, keep_default_na=False,
+                           na_values={c: [''] for c in columns if dtype.get(c) != 'category'})
+    table = _scan(path, columns, start_date, end_date)
+    for c, t in dtype.items():
+        if t == 'category':
+            labels = pc.fill_null(table.column(c).cast(pa.string()), '')
+            table = table.set_column(table.column_names.index(c), c, labels)
+    return table.to_pandas().astype(dtype)
+
+
+def export_csv(path, output_file, columns=None, start_date=None, end_date=None):
+    """Writes a parquet file or dataset back out as csv.
+    """
+    df = read_table(path, columns, start_date, end_date)
+    for c in df.columns:
+        if isinstance(df[c].dtype, pd.CategoricalDtype):
+            df[c] = df[c].astype(object)
+    df.to_csv(output_file, index=False)
+    return output_file
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Convert csv outputs to date-partitioned, compressed parquet')
+    parser.add_argument('--input-files', nargs='+', default=[
+        'output/input_ori.csv', 'output/input_v2.csv',
+        'output/measures/input_measures_bycode_*.csv', 'output/measures/measure_*.csv',
+        'output/measures-week/input_measures_weekly_*.csv', 'output/measures-week/measure_*.csv',
+    ])
+    parser.add_argument('--output-dir', default=COLUMNAR_DIR)
+    parser.add_argument('--root', default=OUTPUT_DIR)
+    args = parser.parse_args()
+
+    for pattern in args.input_files:
+        for path in sorted(glob.glob(pattern)):
+            print(f'{path} -> {convert_csv(path, args.output_dir, args.root)}')
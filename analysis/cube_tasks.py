@@ -0,0 +1,107 @@
+import argparse
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+import pandas as pd
+
+from measure_cube import CUBE_DIR, METADATA, MeasureCube
+
+
+# all a worker needs to reach the cube: the arrays themselves are
+# memory-mapped read-only, so every process shares the same pages
+CubeHandle = namedtuple('CubeHandle', ['cube_dir'])
+
+
+@lru_cache(maxsize=8)
+def _attach(handle, version):
+    return MeasureCube.load(handle.cube_dir, mmap_mode='r')
+
+
+def attach(handle):
+    """The cube behind `handle`, mapped once per process and build: the
+    mapping is keyed on the mtime of the cube's metadata, which build_cube
+    writes last, so a rebuilt cube is mapped afresh.
+    """
+    return _attach(handle, os.stat(os.path.join(handle.cube_dir, METADATA)).st_mtime_ns)
+
+
+def _init_worker():
+    # workers only draw to files: no display backend
+    try:
+        import matplotlib
+    except ImportError:
+        return
+    matplotlib.use('Agg')
+
+
+def _run(handle, func, measure_id, as_frame, kwargs):
+    cube = attach(handle)
+    if as_frame:
+        return func(cube.to_frame(measure_id), **kwargs)
+    return func(cube, measure_id, **kwargs)
+
+
+def map_measures(func, handle, measure_ids=None, workers=1, as_frame=False, **kwargs):
+    """Runs `func` for every measure of the cube (or `measure_ids`), across
+    `workers` processes. `func` is called as `func(cube, measure_id,
+    **kwargs)`, or with `as_frame` as `func(df, **kwargs)` on the measure's
+    long table, for functions written against measure files such as
+    add_percentiles. `func` must be importable (defined at module level).
+    Returns {measure id: result}.
+    """
+    measure_ids = list(attach(handle).measure_ids if measure_ids is None else measure_ids)
+    n = len(measure_ids)
+    args = ([handle] * n, [func] * n, measure_ids, [as_frame] * n, [kwargs] * n)
+    if workers <= 1 or n <= 1:
+        results = list(map(_run, *args))
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+            results = list(pool.map(_run, *args))
+    return dict(zip(measure_ids, results))
+
+
+def measure_percentiles(cube, measure_id, show_outer_percentiles=True):
+    df = cube.percentiles(measure_id, show_outer_percentiles)
+    df.insert(0, 'measure', measure_id)
+    return df
+
+
+def plot_deciles(cube, measure_id, output_dir=os.path.join('output', 'plots'), rate_per=1000):
+    """Saves a decile chart of the practice rates of one measure, as
+    `deciles_<id>.jpeg`, and returns its path.
+    """
+    import matplotlib.pyplot as plt
+
+    df = cube.percentiles(measure_id, show_outer_percentiles=False)
+    fig, ax = plt.subplots(figsize=(12, 8))
+    for percentile, group in df.groupby('percentile'):
+        style = {'color': 'blue', 'linestyle': '-' if percentile == 50 else '--',
+                 'linewidth': 1.2 if percentile == 50 else 1}
+        ax.plot(group['date'], group['value'] * rate_per, **style)
+    ax.set_title(measure_id)
+    ax.set_ylabel(f'Rate per {rate_per}')
+    ax.set_xlabel('Date')
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, f'deciles_{measure_id}.jpeg')
+    fig.savefig(path, bbox_inches='tight')
+    plt.close(fig)
+    return path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Percentiles and decile charts for every measure of the cube, in parallel')
+    parser.add_argument('--cube-dir', default=CUBE_DIR)
+    parser.add_argument('--measures', nargs='+')
+    parser.add_argument('--output-dir', default=os.path.join('output', 'plots'))
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    handle = CubeHandle(args.cube_dir)
+    percentiles = map_measures(measure_percentiles, handle, args.measures, args.workers)
+    os.makedirs(args.output_dir, exist_ok=True)
+    pd.concat(percentiles.values(), ignore_index=True).to_csv(
+        os.path.join(args.output_dir, 'measure_percentiles.csv'), index=False)
+    map_measures(plot_deciles, handle, args.measures, args.workers, output_dir=args.output_dir)
@@ -0,0 +1,184 @@
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from measures_engine import DEFAULT_STUDY, POPULATION_COLUMN, list_inputs
+from patient_counts import file_stat, stale_months
+
+
+DENOMINATOR_DIR = os.path.join('output', 'denominators')
+MANIFEST = 'manifest.json'
+# the finest grain kept; any group_by over a subset of these is a sum
+STRATA = ['practice', 'age_band', 'sex', 'imd', 'ethnicity', 'region']
+
+
+def read_strata(path, strata=STRATA):
+    """The `strata` columns of a cohort file (those it has), as categories.
+    """
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        from columnar import read_columns
+        available = set(pq.read_schema(path).names)
+        columns = [c for c in strata if c in available]
+        return read_columns(path, columns, {c: 'category' for c in columns})
+    available = set(pd.read_csv(path, nrows=0).columns)
+    columns = [c for c in strata if c in available]
+    return pd.read_csv(path, usecols=columns, dtype='category', keep_default_na=False)
+
+
+def count_population(df, strata=STRATA):
+    """Patients per combination of the `strata` present in `df`.
+    """
+    columns = [c for c in strata if c in df.columns]
+    if not columns:
+        return pd.DataFrame({POPULATION_COLUMN: [len(df)]})
+    return df.groupby(columns, observed=True).size().rename(POPULATION_COLUMN).reset_index()
+
+
+def denominators_for_file(path, strata=STRATA):
+    return count_population(read_strata(path, strata), strata)
+
+
+def denominator_path(store_dir, date):
+    return os.path.join(store_dir, f'denominators_{date}.csv')
+
+
+def _load_manifest(store_dir):
+    path = os.path.join(store_dir, MANIFEST)
+    if not os.path.exists(path):
+        return {"study": None, "strata": None, "inputs": {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_manifest(manifest, store_dir):
+    path = os.path.join(store_dir, MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def update_denominators(inputs, store_dir=DENOMINATOR_DIR, strata=STRATA, workers=1,
+                        study_name=DEFAULT_STUDY):
+    """Counts the population of every {date: path} cohort file of
+    `study_name` per combination of `strata`, once: periods whose input is
+    unchanged since the last run (for the same study and strata) are kept.
+    Returns the dates recounted.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    manifest = _load_manifest(store_dir)
+    if manifest.get("study") != study_name or manifest["strata"] != list(strata):
+        manifest = {"study": study_name, "strata": list(strata), "inputs": {}}
+    changed = stale_months(inputs, manifest["inputs"])
+    for date in inputs:
+        if date not in changed and not os.path.exists(denominator_path(store_dir, date)):
+            changed[date] = None
+
+    dates = sorted(changed)
+    paths = [inputs[d] for d in dates]
+    all_strata = [strata] * len(dates)
+    if workers <= 1 or len(dates) <= 1:
+        counts = list(map(denominators_for_file, paths, all_strata))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            counts = list(pool.map(denominators_for_file, paths, all_strata))
+
+    for date, df in zip(dates, counts):
+        df.to_csv(denominator_path(store_dir, date), index=False)
+        digest = changed[date] or manifest["inputs"].get(date, {}).get("sha256")
+        manifest["inputs"][date] = {**file_stat(inputs[date]), "sha256": digest}
+    for date in set(manifest["inputs"]) - set(inputs):
+        del manifest["inputs"][date]
+    _save_manifest(manifest, store_dir)
+    return dates
+
+
+def check_store(store_dir, study_name, inputs):
+    """Raises ValueError unless the store was counted for `study_name` from
+    the same {date: path} inputs: the sha256 of every period it has must
+    match the current input file. Periods it does not have are not checked.
+    """
+    manifest = _load_manifest(store_dir)
+    if manifest.get("study") != study_name:
+        raise ValueError(f'the denominator store in {store_dir} is for {manifest.get("study")}, '
+                         f'not {study_name}; rerun denominators.py')
+    stored = {date: dict(entry) for date, entry in manifest["inputs"].items() if date in inputs}
+    changed = sorted(stale_months({date: inputs[date] for date in stored}, stored))
+    if changed:
+        raise ValueError(f'the denominator store in {store_dir} is out of date for {changed}; '
+                         f'rerun denominators.py')
+
+
+def read_denominators(store_dir=DENOMINATOR_DIR, date=None):
+    """One period's denominators, or those of every period with a `date`
+    column when `date` is None; None if the store does not have the period.
+    Raises FileNotFoundError when the store has no periods at all.
+    """
+    if date is not None:
+        path = denominator_path(store_dir, date)
+        if not os.path.exists(path):
+            return None
+        df = pd.read_csv(path, keep_default_na=False)
+        strata = [c for c in df.columns if c != POPULATION_COLUMN]
+        return df.astype({c: 'category' for c in strata})
+    frames = []
+    for date in sorted(_load_manifest(store_dir)["inputs"]):
+        df = read_denominators(store_dir, date)
+        if df is not None:
+            df['date'] = date
+            frames.append(df)
+    if not frames:
+        raise FileNotFoundError(f'no denominators in {store_dir}; run denominators.py first')
+    return pd.concat(frames, ignore_index=True)
+
+
+def population(denominators, keys):
+    """Population per combination of `keys` (a subset of the stored strata,
+    plus `date` for a multi-period store), summed from the stored counts.
+    """
+    keys = list(keys)
+    missing = set(keys) - set(denominators.columns)
+    if missing:
+        raise KeyError(f'not in the denominator store: {sorted(missing)}')
+    if not keys:
+        return pd.DataFrame({POPULATION_COLUMN: [denominators[POPULATION_COLUMN].sum()]})
+    return denominators.groupby(keys, observed=True)[POPULATION_COLUMN].sum().reset_index()
+
+
+def _as_text(df):
+    # keys as text, with dates as 'YYYY-MM-DD' as the store keeps them
+    return pd.DataFrame({c: df[c].dt.strftime('%Y-%m-%d') if pd.api.types.is_datetime64_any_dtype(df[c])
+                         else df[c].astype(str) for c in df.columns})
+
+
+def join_population(df, denominators, keys, column=POPULATION_COLUMN):
+    """Adds the population of each row's `keys` as `column`, matching keys
+    by their text, so that categories, ints and dates all join. Rows whose
+    keys the store does not have get NaN, not a zero population.
+    """
+    keys = list(keys)
+    totals = population(denominators, keys).rename(columns={POPULATION_COLUMN: column})
+    left = _as_text(df[keys]).reset_index(drop=True)
+    right = _as_text(totals[keys])
+    right[column] = totals[column].to_numpy()
+    df = df.drop(columns=column, errors='ignore').reset_index(drop=True)
+    df[column] = left.merge(right, on=keys, how='left')[column].to_numpy()
+    return df
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Count the population of every period per practice and demographic stratum, once')
+    parser.add_argument('--study-definition', default=DEFAULT_STUDY)
+    parser.add_argument('--input-dir', default=os.path.join('output', 'measures'))
+    parser.add_argument('--store-dir', default=DENOMINATOR_DIR)
+    parser.add_argument('--strata', nargs='+', default=STRATA)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    recounted = update_denominators(list_inputs(args.input_dir, args.study_definition),
+                                    args.store_dir, args.strata, args.workers, args.study_definition)
+    print(f'recounted {len(recounted)} period(s)')
@@ -0,0 +1,136 @@
+import argparse
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+
+REDACTION_THRESHOLD = 5
+
+# columns of measure files that identify a cell rather than count anything
+KEY_COLUMNS = {'date', 'practice', 'region', 'stp', 'sex', 'age_band', 'imd',
+               'ethnicity', 'event_x_event_code'}
+DENOMINATOR = 'population'
+RATE = 'value'
+
+
+def suppression_mask(n, block, threshold=REDACTION_THRESHOLD, secondary=True):
+    """Cells of `n` to redact, block by block (`block` holds an integer code
+    per cell). As the R `redactor`:
+    a) counts in 1..threshold are redacted and
+    b) if the sum of the cells redacted in a) is still <= threshold, the next
+    smallest count in the block is also redacted.
+    """
+    n = np.asarray(n, dtype=float)
+    block = np.asarray(block)
+    valid = ~np.isnan(n)
+    primary = valid & (n >= 1) & (n <= threshold)
+    if not secondary or not primary.any():
+        return primary
+
+    n_blocks = block.max() + 1
+    redacted_sum = np.bincount(block, weights=np.where(primary, n, 0), minlength=n_blocks)
+    any_primary = np.bincount(block, weights=primary, minlength=n_blocks) > 0
+    needs_secondary = any_primary & (redacted_sum <= threshold)
+
+    # smallest remaining count per block, first occurrence on ties
+    candidate = np.where(primary | ~valid, np.inf, n)
+    order = np.lexsort((candidate, block))
+    first = order[np.r_[True, block[order][1:] != block[order][:-1]]]
+    first = first[needs_secondary[block[first]] & np.isfinite(candidate[first])]
+
+    mask = primary.copy()
+    mask[first] = True
+    return mask
+
+
+def round_counts(n, base):
+    """Rounds counts to the nearest multiple of `base`, halves rounding up.
+    """
+    return base * np.floor(np.asarray(n, dtype=float) / base + 0.5)
+
+
+def redact(df, columns, threshold=REDACTION_THRESHOLD, block_by=None,
+           secondary=True, round_to=None, rates=None):
+    """Applies small-number suppression to the count `columns` of `df`,
+    masking only the affected cells.
+
+    Secondary suppression is applied within each block of `block_by` (e.g.
+    each date of a measure file). `rates` maps a derived column to the
+    (numerator, denominator) it is calculated from: it is masked wherever
+    either is, and recalculated from the rounded counts when `round_to` is
+    set. Returns a new DataFrame.
+    """
+    df = df.copy()
+    rates = {} if rates is None else rates
+    if block_by:
+        block = df.groupby(block_by, sort=False, dropna=False).ngroup().to_numpy()
+    else:
+        block = np.zeros(len(df), dtype=np.int64)
+
+    masks = {}
+    for c in columns:
+        masks[c] = suppression_mask(df[c].to_numpy(dtype=float), block, threshold, secondary)
+        if round_to:
+            df[c] = round_counts(df[c], round_to)
+        df[c] = df[c].mask(masks[c])
+
+    for rate, (numerator, denominator) in rates.items():
+        if round_to:
+            df[rate] = df[numerator] / df[denominator]
+        mask = masks.get(numerator, False) | masks.get(denominator, False)
+        df[rate] = df[rate].mask(mask)
+    return df
+
+
+def redact_measure_file(path, output_path, threshold=REDACTION_THRESHOLD,
+                        secondary=True, round_to=None):
+    """Redacts a `measure_*.csv` file: the numerator and `population` are
+    suppressed within each date, and `value` wherever either is.
+    """
+    df = pd.read_csv(path)
+    counts = [c for c in df.columns
+              if c not in KEY_COLUMNS and c != RATE and pd.api.types.is_numeric_dtype(df[c])]
+    numerators = [c for c in counts if c != DENOMINATOR]
+    rates = {}
+    if RATE in df.columns and DENOMINATOR in df.columns and len(numerators) == 1:
+        rates[RATE] = (numerators[0], DENOMINATOR)
+    block_by = ['date'] if 'date' in df.columns else None
+
+    df = redact(df, counts, threshold, block_by, secondary, round_to, rates)
+    df.to_csv(output_path, index=False)
+    return output_path
+
+
+def redact_directory(input_files, output_dir, threshold=REDACTION_THRESHOLD,
+                     secondary=True, round_to=None, workers=1):
+    """Redacts every measure file matching the `input_files` glob, writing
+    `redacted_<name>.csv` files to `output_dir`.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    paths = sorted(glob.glob(input_files))
+    outputs = [os.path.join(output_dir, f'redacted_{os.path.basename(p)}') for p in paths]
+    args = [paths, outputs, [threshold] * len(paths), [secondary] * len(paths),
+            [round_to] * len(paths)]
+    if workers <= 1:
+        return list(map(redact_measure_file, *args))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(redact_measure_file, *args))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Small-number suppression for measure files')
+    parser.add_argument('--input-files', default='output/measures/measure_*.csv')
+    parser.add_argument('--output-dir', default=os.path.join('output', 'tables'))
+    parser.add_argument('--threshold', type=int, default=REDACTION_THRESHOLD)
+    parser.add_argument('--no-secondary', dest='secondary', action='store_false',
+                        help='skip the next-smallest secondary suppression')
+    parser.add_argument('--round-to', type=int, choices=[5, 10],
+                        help='round unsuppressed counts to the nearest 5 or 10')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    redact_directory(args.input_files, args.output_dir, args.threshold,
+                     args.secondary, args.round_to, args.workers)
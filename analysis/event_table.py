@@ -0,0 +1,146 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.dataset as ds
+
+from columnar import COLUMNAR_DIR, read_table, write_table
+
+
+EVENT_TABLE = os.path.join(COLUMNAR_DIR, 'events.parquet')
+EVENT_COLUMNS = ['patient_id', 'date', 'code']
+CALENDARS = ('month', 'week', 'quarter')
+# per-patient counts, summed over whole codelists, can pass int16's 32767
+COUNT_DTYPE = np.uint32
+
+
+def write_event_table(events_file, path=EVENT_TABLE):
+    """Stores an event-level extract (one row per matched event: patient_id,
+    date, code) as parquet sorted by date, so that the row-group statistics
+    let a period be read without touching the rest of the table.
+    """
+    table = pv.read_csv(events_file, convert_options=pv.ConvertOptions(
+        include_columns=EVENT_COLUMNS,
+        column_types={'patient_id': pa.int64(), 'date': pa.string(), 'code': pa.string()}))
+    table = table.sort_by([('date', 'ascending'), ('patient_id', 'ascending')])
+    table = table.set_column(table.column_names.index('code'), 'code',
+                             table.column('code').dictionary_encode())
+    write_table(table, path)
+    return path
+
+
+def read_events(path=EVENT_TABLE, start_date=None, end_date=None, codes=None):
+    """Events between `start_date` and `end_date` (inclusive), optionally
+    only of `codes`, with both filters pushed down to the parquet reader.
+    """
+    codes_filter = ds.field('code').isin([str(c) for c in codes]) if codes is not None else None
+    events = read_table(path, EVENT_COLUMNS, start_date, end_date, filter=codes_filter)
+    events['code'] = events['code'].astype('category')
+    return events
+
+
+def period_start(dates, calendar):
+    """Start of the `calendar` period (month, ISO week starting Monday, or
+    quarter) each date falls in, as datetime64[D].
+    """
+    days = np.asarray(dates, dtype='datetime64[D]')
+    if calendar == 'month':
+        return days.astype('datetime64[M]').astype('datetime64[D]')
+    if calendar == 'week':
+        # 1970-01-01 was a Thursday, so Mondays are 4 days on from multiples of 7
+        return days - (days.astype(np.int64) - 4) % 7
+    if calendar == 'quarter':
+        months = days.astype('datetime64[M]').astype(np.int64)
+        return (months - months % 3).astype('datetime64[M]').astype('datetime64[D]')
+    raise ValueError(f'calendar must be one of {CALENDARS}, not {calendar!r}')
+
+
+def count_matrix(events, calendar, codes):
+    """Counts each patient's events of each of `codes` per period; other
+    codes are ignored. Returns (period starts, patient id per row, row
+    bounds of each period, rows x codes count matrix), rows sorted by period
+    and then patient, holding only patients with an event in the period.
+    """
+    column = pd.Categorical(events['code'].astype(str), categories=list(codes)).codes
+    keep = column >= 0
+
+    periods, period = np.unique(period_start(events['date'].to_numpy()[keep], calendar),
+                                return_inverse=True)
+    patient_ids = events['patient_id'].to_numpy()[keep]
+    column = column[keep].astype(np.int64)
+
+    # one sort orders events by period, then patient, then column
+    order = np.lexsort((column, patient_ids, period))
+    period, patient_ids, column = period[order], patient_ids[order], column[order]
+    new_row = np.r_[True, (period[1:] != period[:-1]) | (patient_ids[1:] != patient_ids[:-1])]
+    row = np.cumsum(new_row) - 1
+    n_rows = row[-1] + 1 if len(row) else 0
+    counts = np.bincount(row * len(codes) + column,
+                         minlength=n_rows * len(codes)).reshape(n_rows, len(codes))
+    bounds = np.searchsorted(period[new_row], np.arange(len(periods) + 1))
+    return [str(p) for p in periods], patient_ids[new_row], bounds, counts
+
+
+def period_frames(periods, patient_ids, bounds, counts, columns):
+    """Splits a count matrix into {period: frame of patient_id and `columns`}.
+    """
+    results = {}
+    for i, period in enumerate(periods):
+        rows = slice(bounds[i], bounds[i + 1])
+        frame = pd.DataFrame(counts[rows].astype(COUNT_DTYPE), columns=columns)
+        frame.insert(0, 'patient_id', patient_ids[rows])
+        results[period] = frame
+    return results
+
+
+def count_events(events, calendar='month', columns=None):
+    """Counts each patient's events per period and code, as
+    `number_of_matches_in_period` does for a one-code codelist per period.
+
+    `columns` maps codes to output column names (all codes in `events` as
+    `snomed_<code>` by default). Returns {period start 'YYYY-MM-DD': frame
+    of patient_id and one count column per code}, for patients with at
+    least one event in the period.
+    """
+    if columns is None:
+        columns = {c: f'snomed_{c}' for c in sorted(events['code'].astype(str).unique())}
+    periods, patient_ids, bounds, counts = count_matrix(events, calendar, list(columns))
+    return period_frames(periods, patient_ids, bounds, counts, list(columns.values()))
+
+
+def write_period_files(results, output_dir, name):
+    """Writes {period: frame} as `input_<name>_<period>.csv`, as
+    `generate_cohort --index-date-range` names its outputs.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for period, frame in sorted(results.items()):
+        path = os.path.join(output_dir, f'input_{name}_{period}.csv')
+        frame.to_csv(path, index=False)
+        paths.append(path)
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Bin an event-level extract into per-period count files')
+    parser.add_argument('--events', default=os.path.join('output', 'input_events.csv'),
+                        help='event-level csv with patient_id, date and code columns')
+    parser.add_argument('--event-table', default=EVENT_TABLE)
+    parser.add_argument('--calendar', choices=CALENDARS, default='month')
+    parser.add_argument('--start-date', help='start of the first period; earlier events are not read')
+    parser.add_argument('--end-date', help='end of the last period; later events are not read')
+    parser.add_argument('--output-dir', default=os.path.join('output', 'events'))
+    parser.add_argument('--name', default='events')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.event_table) or (
+            os.path.exists(args.events)
+            and os.path.getmtime(args.events) > os.path.getmtime(args.event_table)):
+        write_event_table(args.events, args.event_table)
+    events = read_events(args.event_table, args.start_date, args.end_date)
+    write_period_files(count_events(events, args.calendar), args.output_dir,
+                       f'{args.name}_{args.calendar}')
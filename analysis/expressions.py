@@ -0,0 +1,279 @@
+import operator
+import re
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+
+# the dialect of patients.satisfying and categorised_as conditions: names,
+# numbers, 'strings', comparisons, + - * /, AND/OR/NOT and brackets
+TOKEN = re.compile(r"""\s*(?:
+    (?P<number>\d+\.\d*|\.\d+|\d+)
+  | (?P<string>'[^']*')
+  | (?P<name>[A-Za-z_]\w*)
+  | (?P<comparison>>=|<=|!=|<>|=|<|>)
+  | (?P<operator>[-+*/])
+  | (?P<paren>[()])
+)""", re.VERBOSE)
+KEYWORDS = {'AND', 'OR', 'NOT'}
+BOOLEAN = {'or', 'and', 'not', 'compare', 'truthy'}
+
+COMPARISONS = {'=': operator.eq, '!=': operator.ne, '<>': operator.ne, '<': operator.lt,
+               '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+ARITHMETIC = {'+': operator.add, '-': operator.sub, '*': operator.mul, '/': operator.truediv}
+
+
+class InvalidExpressionError(ValueError):
+    pass
+
+
+def tokenize(expression):
+    tokens = []
+    expression = expression.strip()
+    position = 0
+    while position < len(expression):
+        match = TOKEN.match(expression, position)
+        if not match:
+            raise InvalidExpressionError(f'unexpected {expression[position:]!r} in {expression!r}')
+        kind, value = match.lastgroup, match.group(match.lastgroup)
+        if kind == 'name' and value.upper() in KEYWORDS:
+            kind, value = 'keyword', value.upper()
+        elif kind == 'number':
+            value = float(value) if '.' in value else int(value)
+        elif kind == 'string':
+            value = value[1:-1]
+        tokens.append((kind, value))
+        position = match.end()
+    return tokens
+
+
+class _Parser:
+    """Recursive descent over the tokens, into nested tuples. Columns used
+    outside a comparison or arithmetic are tested for truth, as
+    cohortextractor does (`x` means `x != 0`, or `x != ''` for text).
+    Arithmetic on constants is folded.
+    """
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.tokens = tokenize(expression)
+        self.position = 0
+
+    def parse(self):
+        node = self.boolean(self.disjunction())
+        if self.position != len(self.tokens):
+            self.error(f'unexpected {self.tokens[self.position][1]!r}')
+        return node
+
+    def error(self, message):
+        raise InvalidExpressionError(f'{message} in {self.expression!r}')
+
+    def peek(self, kind, value=None):
+        if self.position < len(self.tokens):
+            token = self.tokens[self.position]
+            if token[0] == kind and (value is None or token[1] == value):
+                return token
+        return None
+
+    def take(self, kind, value=None):
+        token = self.peek(kind, value)
+        if token:
+            self.position += 1
+        return token
+
+    def boolean(self, node):
+        return node if node[0] in BOOLEAN else ('truthy', node)
+
+    def disjunction(self):
+        node = self.conjunction()
+        while self.take('keyword', 'OR'):
+            node = ('or', self.boolean(node), self.boolean(self.conjunction()))
+        return node
+
+    def conjunction(self):
+        node = self.negation()
+        while self.take('keyword', 'AND'):
+            node = ('and', self.boolean(node), self.boolean(self.negation()))
+        return node
+
+    def negation(self):
+        if self.take('keyword', 'NOT'):
+            return ('not', self.boolean(self.negation()))
+        return self.comparison()
+
+    def comparison(self):
+        node = self.sum()
+        token = self.take('comparison')
+        if token:
+            node = ('compare', token[1], node, self.sum())
+        return node
+
+    def sum(self):
+        node = self.product()
+        while self.peek('operator', '+') or self.peek('operator', '-'):
+            node = self._arithmetic(self.take('operator')[1], node, self.product())
+        return node
+
+    def product(self):
+        node = self.factor()
+        while self.peek('operator', '*') or self.peek('operator', '/'):
+            node = self._arithmetic(self.take('operator')[1], node, self.factor())
+        return node
+
+    def factor(self):
+        if self.take('operator', '-'):
+            return self._arithmetic('-', ('constant', 0), self.factor())
+        for kind in ('number', 'string'):
+            token = self.take(kind)
+            if token:
+                return ('constant', token[1])
+        token = self.take('name')
+        if token:
+            return ('column', token[1])
+        if self.take('paren', '('):
+            node = self.disjunction()
+            if not self.take('paren', ')'):
+                self.error('missing )')
+            return node
+        self.error('expected a value')
+
+    @staticmethod
+    def _arithmetic(op, left, right):
+        if left[0] == 'constant' and right[0] == 'constant':
+            return ('constant', ARITHMETIC[op](left[1], right[1]))
+        return ('arithmetic', op, left, right)
+
+
+def _names(node):
+    if node[0] == 'column':
+        return {node[1]}
+    return set().union(*(_names(child) for child in node[1:] if isinstance(child, tuple)))
+
+
+def _values(x):
+    # a column as numpy (text columns as str arrays), or a Categorical as is
+    if isinstance(x, pd.Series):
+        if isinstance(x.dtype, pd.CategoricalDtype):
+            return x.array
+        if pd.api.types.is_numeric_dtype(x) or pd.api.types.is_bool_dtype(x):
+            return x.to_numpy()
+        return x.fillna('').to_numpy(dtype=str)
+    return x
+
+
+def _plain(values, other):
+    # a Categorical as a plain array, numeric when compared with numbers
+    if isinstance(other, (int, float)) or (isinstance(other, np.ndarray) and other.dtype.kind in 'fiub'):
+        return pd.to_numeric(pd.Series(values, dtype=object), errors='coerce').to_numpy(dtype=float)
+    return pd.Series(values, dtype=object).fillna('').to_numpy(dtype=str)
+
+
+def _compare(op, left, right):
+    # a categorical against a constant is compared through its categories,
+    # so only the few distinct values are compared
+    if isinstance(right, pd.Categorical) and np.isscalar(left):
+        return _compare({'<': '>', '>': '<', '<=': '>=', '>=': '<='}.get(op, op), right, left)
+    if isinstance(left, pd.Categorical) and np.isscalar(right):
+        matches = _compare(op, _plain(left.categories, right), right)
+        return np.append(np.asarray(matches, dtype=bool), False)[left.codes]
+    if isinstance(left, pd.Categorical):
+        left = _plain(left, right)
+    if isinstance(right, pd.Categorical):
+        right = _plain(right, left)
+
+    with np.errstate(invalid='ignore'):
+        result = COMPARISONS[op](left, right)
+    # as in SQL, comparisons with a missing number are never true
+    for side in (left, right):
+        if isinstance(side, np.ndarray) and side.dtype.kind == 'f':
+            result = result & ~np.isnan(side)
+        elif isinstance(side, float) and np.isnan(side):
+            result = result & False
+    return result
+
+
+def _truthy(value):
+    if isinstance(value, pd.Categorical):
+        true = np.append(np.asarray(value.categories.astype(str) != ''), False)
+        return true[value.codes]
+    if isinstance(value, np.ndarray) and value.dtype.kind in 'US':
+        return value != ''
+    if isinstance(value, np.ndarray) and value.dtype.kind == 'b':
+        return value
+    return _compare('!=', value, 0)
+
+
+def _evaluate(node, columns):
+    kind = node[0]
+    if kind == 'constant':
+        return node[1]
+    if kind == 'column':
+        return columns[node[1]]
+    if kind == 'truthy':
+        return _truthy(_evaluate(node[1], columns))
+    if kind == 'not':
+        return ~_evaluate(node[1], columns)
+    if kind == 'and':
+        return _evaluate(node[1], columns) & _evaluate(node[2], columns)
+    if kind == 'or':
+        return _evaluate(node[1], columns) | _evaluate(node[2], columns)
+    if kind == 'compare':
+        return _compare(node[1], _evaluate(node[2], columns), _evaluate(node[3], columns))
+    if kind == 'arithmetic':
+        left, right = (_evaluate(child, columns) for child in node[2:])
+        left, right = (_plain(v, 0) if isinstance(v, pd.Categorical) else v for v in (left, right))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return ARITHMETIC[node[1]](left, right)
+    raise InvalidExpressionError(f'unknown node {kind}')
+
+
+class Expression:
+    """A compiled condition: `evaluate(df)` returns a boolean array with one
+    numpy operation per node of the parsed expression.
+    """
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.tree = _Parser(expression).parse()
+        self.names = _names(self.tree)
+
+    def evaluate(self, df):
+        missing = self.names - set(df.columns)
+        if missing:
+            raise InvalidExpressionError(f'unknown columns {sorted(missing)} in {self.expression!r}')
+        columns = {name: _values(df[name]) for name in self.names}
+        result = _evaluate(self.tree, columns)
+        return np.broadcast_to(np.asarray(result, dtype=bool), (len(df),)).copy()
+
+
+@lru_cache(maxsize=1024)
+def compile_expression(expression):
+    """Parses `expression` once; later calls with the same string return the
+    same compiled Expression.
+    """
+    return Expression(expression)
+
+
+def satisfying(df, expression):
+    """Boolean mask of the rows of `df` meeting a patients.satisfying
+    condition, e.g. `(age_ !=0) AND (NOT died) AND (registered)`.
+    """
+    return compile_expression(expression).evaluate(df)
+
+
+def categorised_as(df, categories):
+    """Labels the rows of `df` with a categorised_as dict: the first label
+    (in the dict's order) whose condition holds, the DEFAULT label where
+    none does. Returns a Categorical with the labels in the dict's order.
+    """
+    labels = [str(label) for label in categories]
+    default = [i for i, condition in enumerate(categories.values()) if condition.strip() == 'DEFAULT']
+    conditions, positions = [], []
+    for i, condition in enumerate(categories.values()):
+        if condition.strip() != 'DEFAULT':
+            conditions.append(compile_expression(condition).evaluate(df))
+            positions.append(i)
+    codes = np.select(conditions, positions, default[0] if default else -1) if conditions \
+        else np.full(len(df), default[0] if default else -1)
+    return pd.Categorical.from_codes(codes, categories=labels)
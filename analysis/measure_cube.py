@@ -0,0 +1,234 @@
+import argparse
+import glob
+import json
+import os
+import re
+import shutil
+import tempfile
+import warnings
+
+import numpy as np
+import pandas as pd
+
+
+CUBE_DIR = os.path.join('output', 'cube')
+METADATA = 'measures.json'
+# written to a temporary directory, then moved into the cube in this
+# order: metadata last, so it marks a complete cube
+CUBE_FILES = ['numerator.npy', 'denominator.npy', 'practices.npy', 'periods.npy', METADATA]
+MEASURE_FILES = os.path.join('output', 'measures', 'measure_*_practice*.csv')
+MEASURE_ID = re.compile(r'^measure_(.+)\.csv$')
+# decile and outer percentile positions, as utilities.add_percentiles
+DECILES = np.arange(0.1, 1, 0.1)
+OUTER_PERCENTILES = np.concatenate((np.arange(0.01, 0.1, 0.01), np.arange(0.91, 1, 0.01)))
+
+
+def list_measure_files(pattern=MEASURE_FILES):
+    """Returns {measure id: path} for practice-level measure files.
+    """
+    files = {}
+    for path in sorted(glob.glob(pattern)):
+        match = MEASURE_ID.match(os.path.basename(path))
+        if match:
+            files[match.group(1)] = path
+    return files
+
+
+def read_measure_file(path):
+    """A practice-level measure file with its numerator and denominator
+    column names: the two columns besides practice, value and date.
+    """
+    df = pd.read_csv(path, keep_default_na=False, na_values=[''])
+    counts = [c for c in df.columns if c not in ('practice', 'value', 'date')]
+    if len(counts) != 2 or 'practice' not in df.columns:
+        raise ValueError(f'{path} is not a practice-level measure file: {list(df.columns)}')
+    return df, counts[0], counts[1]
+
+
+def build_cube(measure_files, cube_dir=CUBE_DIR):
+    """Writes the cube for {measure id: path}: numerator and denominator as
+    (measure, practice, period) float64 arrays in .npy files, so that each
+    measure's practice x period matrix is contiguous, with the sorted
+    practice ids and periods that index them and the measures' metadata.
+    Practices without a row for a period are NaN.
+
+    The files are written to a temporary directory inside `cube_dir` and
+    then each is os.replace'd into it, metadata last, so processes that
+    have the old cube mapped keep reading the old (unlinked) files.
+    """
+    frames = {measure_id: read_measure_file(path) for measure_id, path in measure_files.items()}
+    practices = np.unique(np.concatenate(
+        [df['practice'].to_numpy(dtype=np.int64) for df, _, _ in frames.values()] or [[]])).astype(np.int64)
+    periods = np.unique(np.concatenate(
+        [df['date'].to_numpy(dtype=str) for df, _, _ in frames.values()] or [[]])).astype('datetime64[D]')
+
+    os.makedirs(cube_dir, exist_ok=True)
+    build_dir = tempfile.mkdtemp(prefix='.build-', dir=cube_dir)
+    try:
+        _write_cube(frames, practices, periods, measure_files, build_dir)
+        for file in CUBE_FILES:
+            os.replace(os.path.join(build_dir, file), os.path.join(cube_dir, file))
+    finally:
+        shutil.rmtree(build_dir, ignore_errors=True)
+    return cube_dir
+
+
+def _write_cube(frames, practices, periods, measure_files, cube_dir):
+    shape = (len(frames), len(practices), len(periods))
+    numerator = np.lib.format.open_memmap(os.path.join(cube_dir, 'numerator.npy'), 'w+', np.float64, shape)
+    denominator = np.lib.format.open_memmap(os.path.join(cube_dir, 'denominator.npy'), 'w+', np.float64, shape)
+    numerator[:] = np.nan
+    denominator[:] = np.nan
+
+    metadata = []
+    for m, (measure_id, (df, numerator_column, denominator_column)) in enumerate(frames.items()):
+        row = np.searchsorted(practices, df['practice'].to_numpy(dtype=np.int64))
+        column = np.searchsorted(periods, df['date'].to_numpy(dtype=str).astype('datetime64[D]'))
+        numerator[m, row, column] = df[numerator_column].to_numpy(dtype=float)
+        denominator[m, row, column] = df[denominator_column].to_numpy(dtype=float)
+        metadata.append({'id': measure_id, 'numerator': numerator_column,
+                         'denominator': denominator_column, 'file': measure_files[measure_id]})
+    numerator.flush()
+    denominator.flush()
+
+    np.save(os.path.join(cube_dir, 'practices.npy'), practices)
+    np.save(os.path.join(cube_dir, 'periods.npy'), periods)
+    with open(os.path.join(cube_dir, METADATA), 'w') as f:
+        json.dump(metadata, f, indent=2)
+
+
+class MeasureCube:
+    """Practice-level measures as (measure, practice, period) numerator and
+    denominator arrays, memory-mapped from the cube directory, so that
+    every query slices the arrays rather than reloading measure files.
+    """
+
+    def __init__(self, practices, periods, numerator, denominator, measures):
+        self.practices = practices
+        self.periods = periods
+        self.numerator = numerator
+        self.denominator = denominator
+        self.measures = measures
+        self.measure_ids = [m['id'] for m in measures]
+
+    @classmethod
+    def load(cls, cube_dir=CUBE_DIR, mmap_mode='r'):
+        with open(os.path.join(cube_dir, METADATA)) as f:
+            measures = json.load(f)
+        return cls(np.load(os.path.join(cube_dir, 'practices.npy')),
+                   np.load(os.path.join(cube_dir, 'periods.npy')),
+                   np.load(os.path.join(cube_dir, 'numerator.npy'), mmap_mode=mmap_mode),
+                   np.load(os.path.join(cube_dir, 'denominator.npy'), mmap_mode=mmap_mode),
+                   measures)
+
+    def measure_index(self, measure_id):
+        return self.measure_ids.index(measure_id)
+
+    def practice_index(self, practices):
+        """Row of each practice id, -1 where the practice is not in the cube.
+        """
+        practices = np.asarray(practices, dtype=np.int64)
+        index = np.minimum(np.searchsorted(self.practices, practices), max(len(self.practices) - 1, 0))
+        found = (len(self.practices) > 0) & (self.practices[index] == practices)
+        return np.where(found, index, -1)
+
+    def counts(self, measure_id):
+        """Practice x period numerator and denominator views of one measure.
+        """
+        m = self.measure_index(measure_id)
+        return self.numerator[m], self.denominator[m]
+
+    def value(self, measure_id):
+        """Practice x period numerator / denominator, NaN where the practice
+        has no row or a zero denominator.
+        """
+        numerator, denominator = self.counts(measure_id)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(denominator > 0, numerator / denominator, np.nan)
+
+    def to_frame(self, measure_id):
+        """The measure as the long table of its measure file (practice,
+        numerator, denominator, value, date), rows present only.
+        """
+        numerator, denominator = self.counts(measure_id)
+        row, column = np.nonzero(~np.isnan(denominator))
+        meta = self.measures[self.measure_index(measure_id)]
+        df = pd.DataFrame({'practice': self.practices[row],
+                           meta['numerator']: numerator[row, column],
+                           meta['denominator']: denominator[row, column]})
+        df['value'] = self.value(measure_id)[row, column]
+        df['date'] = self.periods[column].astype(str)
+        return df
+
+    def percentiles(self, measure_id, show_outer_percentiles=True):
+        """Percentiles of the practice values per period, as add_percentiles:
+        a tidy table of date, percentile and value.
+        """
+        quantiles = np.concatenate((DECILES, OUTER_PERCENTILES)) if show_outer_percentiles else DECILES
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            result = np.nanquantile(self.value(measure_id), quantiles, axis=0)
+        return pd.DataFrame({
+            'date': np.repeat(self.periods, len(quantiles)),
+            'percentile': np.tile(np.rint(quantiles * 100).astype(int), len(self.periods)),
+            'value': result.T.ravel(),
+        })
+
+    def coverage(self, measure_id):
+        """Per period: practices with a row, with a positive denominator,
+        and with any events.
+        """
+        numerator, denominator = self.counts(measure_id)
+        return pd.DataFrame({
+            'date': self.periods,
+            'practices': (~np.isnan(denominator)).sum(axis=0),
+            'practices_with_population': (denominator > 0).sum(axis=0),
+            'practices_with_events': (numerator > 0).sum(axis=0),
+        })
+
+    def relevant_practices(self, measure_id):
+        """Practices whose mean value over the periods is not zero, the ones
+        drop_irrelevant_practices keeps.
+        """
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            mean = np.nanmean(self.value(measure_id), axis=1)
+        return self.practices[mean != 0]
+
+    def adoption_dates(self, measure_id, threshold=0):
+        """First period in which each practice's numerator is above
+        `threshold`, NaT for practices that never get there.
+        """
+        numerator, _ = self.counts(measure_id)
+        above = numerator > threshold
+        first = above.argmax(axis=1)
+        return pd.DataFrame({
+            'practice': self.practices,
+            'adoption_date': np.where(above.any(axis=1), self.periods[first], np.datetime64('NaT')),
+        })
+
+    def practice_series(self, measure_id, practice):
+        """One practice's numerator, denominator and value over the periods.
+        """
+        row = self.practice_index([practice])[0]
+        if row < 0:
+            raise KeyError(f'practice {practice} is not in the cube')
+        numerator, denominator = self.counts(measure_id)
+        meta = self.measures[self.measure_index(measure_id)]
+        return pd.DataFrame({'date': self.periods,
+                             meta['numerator']: numerator[row],
+                             meta['denominator']: denominator[row],
+                             'value': self.value(measure_id)[row]})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Build the practice x period x measure cube from practice-level measure files')
+    parser.add_argument('--measure-files', default=MEASURE_FILES)
+    parser.add_argument('--cube-dir', default=CUBE_DIR)
+    args = parser.parse_args()
+
+    measure_files = list_measure_files(args.measure_files)
+    if not measure_files:
+        parser.error(f'no measure files match {args.measure_files}')
+    build_cube(measure_files, args.cube_dir)
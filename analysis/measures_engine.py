@@ -0,0 +1,338 @@
+import argparse
+import csv
+import hashlib
+import importlib
+import json
+import os
+import re
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from patient_counts import file_stat, stale_months
+from schema import load_schema
+
+
+POPULATION_COLUMN = 'population'
+# the study the measure and denominator CLIs run on by default
+DEFAULT_STUDY = 'study_definition_measures_bycode'
+PARTIALS_DIR = 'measure_partials'
+MANIFEST = 'measure_manifest.json'
+
+MeasureSpec = namedtuple('MeasureSpec', ['id', 'numerator', 'denominator', 'group_by'])
+
+
+def as_spec(measure):
+    """Plain, picklable copy of a cohortextractor `Measure`, with `group_by`
+    as a tuple.
+    """
+    group_by = measure.group_by
+    if group_by is None:
+        group_by = ()
+    elif isinstance(group_by, str):
+        group_by = (group_by,)
+    return MeasureSpec(measure.id, measure.numerator, measure.denominator, tuple(group_by))
+
+
+def load_measures(study_name):
+    """The `measures` list of a study definition in analysis/, as specs.
+    """
+    module = importlib.import_module(study_name)
+    return [as_spec(m) for m in module.measures]
+
+
+def list_inputs(input_dir, study_name):
+    """Returns {date: path} for the cohort files `generate_cohort
+    --index-date-range` writes for `study_name`, sorted by date. A
+    date-partitioned parquet dataset written by columnar.py, at
+    `<input_dir>/input<suffix>` or `input_dir` itself, is used instead when
+    present.
+    """
+    suffix = study_name[len('study_definition'):]
+    pattern = re.compile(rf'^input{re.escape(suffix)}_(\d{{4}}-\d{{2}}-\d{{2}})\.csv$')
+    for dataset in (os.path.join(input_dir, f'input{suffix}'), input_dir):
+        if os.path.isdir(dataset) and any(e.startswith('date=') for e in os.listdir(dataset)):
+            from columnar import list_partitions
+            return list_partitions(dataset)
+    inputs = {}
+    for file in os.listdir(input_dir):
+        match = pattern.match(file)
+        if match:
+            inputs[match.group(1)] = os.path.join(input_dir, file)
+    return dict(sorted(inputs.items()))
+
+
+def load_input(path, measures, schema=None):
+    """Reads only the columns the measures need: group_by columns as
+    categories, as generate_measures does, and numerators and denominators
+    with the compact integer dtypes of the study's `schema` (floats without
+    one).
+    """
+    numeric = {c for m in measures for c in (m.numerator, m.denominator)}
+    group_by = {c for m in measures for c in m.group_by}
+    numeric.discard(POPULATION_COLUMN)
+    group_by.discard(POPULATION_COLUMN)
+    declared = schema.dtype if schema is not None else {}
+    dtype = {c: 'category' for c in group_by}
+    dtype.update({c: declared.get(c, 'float64') for c in numeric})
+    if path.endswith('.parquet'):
+        from columnar import read_columns
+        df = read_columns(path, list(dtype), dtype)
+    else:
+        # blanks stay '' only in the group_by categories; blank counts are NaN
+        df = pd.read_csv(path, dtype=dtype, usecols=list(dtype), keep_default_na=False,
+                         na_values={c: [''] for c in numeric})
+    df[POPULATION_COLUMN] = 1
+    return df
+
+
+def _from_denominators(df, keys, columns, denominators):
+    # population per group from the denominator store; the numerators are
+    # only summed over patients who count towards one
+    from denominators import population
+    counts = [c for c in columns if c != POPULATION_COLUMN]
+    totals = population(denominators, keys)
+    if not keys:
+        sums = df[counts].sum()
+        sums[POPULATION_COLUMN] = totals[POPULATION_COLUMN].iloc[0]
+        return sums.to_frame().T
+    rows = df[counts].ne(0).any(axis=1).to_numpy()
+    numerators = df[rows].groupby(list(keys), observed=True)[counts].sum().reset_index()
+    for c in keys:
+        numerators[c] = numerators[c].astype(str)
+    totals = totals.astype({c: str for c in keys})
+    unknown = numerators.merge(totals[list(keys)], on=list(keys), how='left', indicator=True)
+    unknown = unknown[unknown['_merge'] == 'left_only']
+    if len(unknown):
+        raise ValueError(f'{len(unknown)} {list(keys)} group(s) with events are not in the denominator '
+                         f'store, e.g. {unknown[list(keys)].iloc[0].tolist()}')
+    summed = totals.merge(numerators, on=list(keys), how='left')
+    summed[counts] = summed[counts].fillna(0)
+    summed = summed.astype({c: df[c].dtype for c in keys})
+    return summed.sort_values(list(keys), ignore_index=True)
+
+
+def calculate_measures(df, measures, denominators=None):
+    """Calculates every measure on one patient-level frame. Measures that
+    share group_by keys are summed together in one groupby.
+    With the period's `denominators` (see denominators.py), the population
+    of groups the store covers is taken from it rather than re-counted;
+    groups with events that the store does not have raise ValueError.
+    Returns {measure id: result frame}.
+    """
+    by_keys = {}
+    for m in measures:
+        by_keys.setdefault(m.group_by, []).append(m)
+
+    results = {}
+    for keys, group in by_keys.items():
+        columns = list(dict.fromkeys(c for m in group for c in (m.numerator, m.denominator)))
+        stored = denominators is not None and POPULATION_COLUMN in columns \
+            and set(keys) - {POPULATION_COLUMN} <= set(denominators.columns)
+        if not keys:
+            # no grouping: measures stay at patient level
+            summed = df[columns].copy()
+        elif stored:
+            columns = list(dict.fromkeys(columns + [POPULATION_COLUMN]))
+            total = keys == (POPULATION_COLUMN,)
+            summed = _from_denominators(df, () if total else keys, columns, denominators)
+        elif keys == (POPULATION_COLUMN,):
+            # one group for everyone, keeping the population column
+            columns = list(dict.fromkeys(columns + [POPULATION_COLUMN]))
+            summed = df[columns].sum().to_frame().T
+        else:
+            summed = df.groupby(list(keys), observed=True)[columns].sum().reset_index()
+        # counts are written as floats, as generate_measures does
+        counts = [c for c in columns if c != POPULATION_COLUMN]
+        summed[counts] = summed[counts].astype('float64')
+
+        for m in group:
+            if keys == (POPULATION_COLUMN,):
+                selected = [m.numerator, m.denominator, POPULATION_COLUMN]
+            else:
+                selected = list(keys) + [m.numerator, m.denominator]
+            result = summed[list(dict.fromkeys(selected))].copy()
+            result['value'] = result[m.numerator] / result[m.denominator]
+            results[m.id] = result
+    return results
+
+
+def measures_for_file(path, date, measures, schema=None, denominators=None):
+    results = calculate_measures(load_input(path, measures, schema), measures, denominators)
+    for result in results.values():
+        result['date'] = date
+    return results
+
+
+def _map_files(paths, dates, measures, workers, schema=None, denominator_dir=None, study_name=None):
+    schemas = [schema] * len(paths)
+    if denominator_dir is None:
+        denominators = [None] * len(paths)
+    else:
+        from denominators import check_store, read_denominators
+        check_store(denominator_dir, study_name, dict(zip(dates, paths)))
+        denominators = [read_denominators(denominator_dir, d) for d in dates]
+    if workers <= 1 or len(paths) <= 1:
+        return list(map(measures_for_file, paths, dates, measures, schemas, denominators))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(measures_for_file, paths, dates, measures, schemas, denominators))
+
+
+def _study_measures(study_name, measures, schema):
+    # measures and schema come from the study definition unless given
+    if measures is None:
+        measures = load_measures(study_name)
+        schema = load_schema(study_name) if schema is None else schema
+    return measures, schema
+
+
+def generate_measures(study_name, output_dir, workers=1, measures=None, schema=None,
+                      denominator_dir=None, input_dir=None):
+    """Calculates all measures of `study_name` over its monthly input files
+    (in `input_dir`, by default `output_dir`), reading each file once, and
+    writes one `measure_<id>.csv` per measure to `output_dir` with a `date`
+    column, as `cohortextractor generate_measures` does.
+    Populations come from the denominator store in `denominator_dir` where
+    it has the month; the store must have been counted from the same
+    inputs (see denominators.check_store).
+    """
+    measures, schema = _study_measures(study_name, measures, schema)
+    inputs = list_inputs(output_dir if input_dir is None else input_dir, study_name)
+    dates = list(inputs)
+    per_file = _map_files([inputs[d] for d in dates], dates, [measures] * len(dates), workers, schema,
+                          denominator_dir, study_name)
+
+    outputs = []
+    for m in measures:
+        frames = [results[m.id] for results in per_file]
+        if not frames:
+            continue
+        output_file = os.path.join(output_dir, f'measure_{m.id}.csv')
+        pd.concat(frames, ignore_index=True).to_csv(output_file, index=False)
+        outputs.append(output_file)
+    return outputs
+
+
+def definition_hash(measure):
+    return hashlib.sha256(json.dumps(list(measure)).encode()).hexdigest()
+
+
+def partial_path(output_dir, measure_id, date):
+    return os.path.join(output_dir, PARTIALS_DIR, f'measure_{measure_id}_{date}.csv')
+
+
+def load_manifest(output_dir):
+    path = os.path.join(output_dir, PARTIALS_DIR, MANIFEST)
+    if not os.path.exists(path):
+        return {"inputs": {}, "measures": {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, output_dir):
+    path = os.path.join(output_dir, PARTIALS_DIR, MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def _write_partials(results, output_dir, date):
+    for measure_id, result in results.items():
+        result.drop(columns='date').to_csv(partial_path(output_dir, measure_id, date), index=False)
+
+
+def _combine_partials(output_file, partials):
+    """Concatenates {date: partial csv} into one file with a date column,
+    as cohortextractor combines its per-date measure files.
+    """
+    headers = None
+    with open(output_file, 'w', newline='') as out:
+        writer = csv.writer(out, lineterminator='\n')
+        for date, path in sorted(partials.items()):
+            with open(path, newline='') as f:
+                reader = csv.reader(f)
+                header = next(reader)
+                if headers is None:
+                    headers = header
+                    writer.writerow(headers + ['date'])
+                elif header != headers:
+                    raise RuntimeError(f'{path} has different headers to earlier months')
+                for row in reader:
+                    writer.writerow(row + [date])
+
+
+def update_measures(study_name, output_dir, workers=1, measures=None, schema=None,
+                    denominator_dir=None, input_dir=None):
+    """Incremental `generate_measures`: keeps a partial result per (measure,
+    month) and a manifest of input file hashes and measure definitions, and
+    only recomputes the measures of months whose input is new or changed, or
+    whose definition has changed. The measure files are then rebuilt from
+    the partials. Returns {date: [measure ids recomputed]}.
+    """
+    measures, schema = _study_measures(study_name, measures, schema)
+    os.makedirs(os.path.join(output_dir, PARTIALS_DIR), exist_ok=True)
+    inputs = list_inputs(output_dir if input_dir is None else input_dir, study_name)
+    manifest = load_manifest(output_dir)
+    definitions = {m.id: definition_hash(m) for m in measures}
+
+    changed = stale_months(inputs, manifest["inputs"])
+    tasks = {}
+    for date in inputs:
+        done = manifest["measures"].get(date, {}) if date not in changed else {}
+        stale = [m for m in measures
+                 if done.get(m.id) != definitions[m.id]
+                 or not os.path.exists(partial_path(output_dir, m.id, date))]
+        if stale:
+            tasks[date] = stale
+
+    dates = list(tasks)
+    per_file = _map_files([inputs[d] for d in dates], dates, [tasks[d] for d in dates], workers, schema,
+                          denominator_dir, study_name)
+    for date, results in zip(dates, per_file):
+        _write_partials(results, output_dir, date)
+        if date in changed:
+            manifest["inputs"][date] = {**file_stat(inputs[date]), "sha256": changed[date]}
+            manifest["measures"][date] = {}
+        manifest["measures"].setdefault(date, {}).update(
+            {measure_id: definitions[measure_id] for measure_id in results})
+
+    # months whose input has gone are dropped, as a full rebuild would
+    for date in set(manifest["inputs"]) - set(inputs):
+        for measure_id in manifest["measures"].pop(date, {}):
+            path = partial_path(output_dir, measure_id, date)
+            if os.path.exists(path):
+                os.remove(path)
+        del manifest["inputs"][date]
+    save_manifest(manifest, output_dir)
+
+    for m in measures:
+        partials = {date: partial_path(output_dir, m.id, date) for date in inputs}
+        if partials:
+            _combine_partials(os.path.join(output_dir, f'measure_{m.id}.csv'), partials)
+    return {date: [m.id for m in tasks[date]] for date in dates}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Calculate all measures of a study definition in one pass per input file')
+    parser.add_argument('--study-definition', default=DEFAULT_STUDY)
+    parser.add_argument('--output-dir', default=os.path.join('output', 'measures'))
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--incremental', action='store_true',
+                        help='only recompute months whose input or measure definitions changed')
+    parser.add_argument('--input-dir',
+                        help='read the cohort files, or their columnar dataset, from here '
+                             '(default: --output-dir)')
+    parser.add_argument('--denominator-dir',
+                        help='take populations from this denominator store (see denominators.py)')
+    args = parser.parse_args()
+
+    if args.incremental:
+        recomputed = update_measures(args.study_definition, args.output_dir, args.workers,
+                                     denominator_dir=args.denominator_dir, input_dir=args.input_dir)
+        print(f'recomputed {sum(map(len, recomputed.values()))} measure-month(s) '
+              f'over {len(recomputed)} month(s)')
+    else:
+        generate_measures(args.study_definition, args.output_dir, args.workers,
+                          denominator_dir=args.denominator_dir, input_dir=args.input_dir)
@@ -0,0 +1,128 @@
+import numpy as np
+import pandas as pd
+
+
+class ActivityMatrix:
+    """Bit-packed patient x period matrix of OC activity.
+
+    Patient ids are dictionary-encoded to a dense int32 index (`patient_ids`
+    holds the id for each index) and row i of `packed` holds one bit per
+    period, in `np.packbits` order, set when that patient had an event in that
+    period. Queries unpack the bits once (`bits`) and then reduce whole
+    columns at a time.
+    """
+
+    def __init__(self, patient_ids, periods, packed):
+        self.patient_ids = patient_ids
+        self.periods = periods
+        self.packed = packed
+        self._bits = None
+
+    @classmethod
+    def from_counts(cls, num_patients):
+        """Builds the matrix from {date: ids}, as returned by
+        `patient_counts.load_patient_ids`.
+        """
+        dates = sorted(num_patients)
+        months = [np.asarray(num_patients[date], dtype=np.uint64) for date in dates]
+        patient_ids = np.unique(np.concatenate(months)) if months else np.array([], dtype=np.uint64)
+
+        packed = np.zeros((len(patient_ids), (len(dates) + 7) // 8), dtype=np.uint8)
+        for p, ids in enumerate(months):
+            index = np.searchsorted(patient_ids, ids).astype(np.int32)
+            packed[index, p // 8] |= np.uint8(0x80 >> (p % 8))
+
+        return cls(patient_ids, np.array(dates, dtype='datetime64[D]'), packed)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f['patient_ids'], f['periods'], f['packed'])
+
+    def save(self, path):
+        np.savez_compressed(path, patient_ids=self.patient_ids,
+                            periods=self.periods, packed=self.packed)
+
+    def __len__(self):
+        return len(self.patient_ids)
+
+    def index_of(self, patient_ids):
+        """Dense int32 index for each patient id, -1 where the id is unknown.
+        """
+        patient_ids = np.asarray(patient_ids, dtype=np.uint64)
+        if not len(self):
+            return np.full(len(patient_ids), -1, dtype=np.int32)
+        index = np.minimum(np.searchsorted(self.patient_ids, patient_ids), len(self) - 1)
+        return np.where(self.patient_ids[index] == patient_ids, index, -1).astype(np.int32)
+
+    def period_index(self, date):
+        """Position of the last period on or before `date`.
+        """
+        return int(np.searchsorted(self.periods, np.datetime64(date, 'D'), side='right')) - 1
+
+    def active(self, period):
+        """Boolean mask over patients active in the period at position `period`.
+        """
+        return (self.packed[:, period // 8] & np.uint8(0x80 >> (period % 8))) != 0
+
+    def bits(self):
+        """The unpacked patient x period matrix of 0/1 uint8, unpacked on
+        first use and kept.
+        """
+        if self._bits is None:
+            self._bits = np.unpackbits(self.packed, axis=1, count=len(self.periods))
+        return self._bits
+
+    def months_active(self, start=0, stop=None):
+        """Number of active periods per patient within periods[start:stop].
+        """
+        return self.bits()[:, start:stop].sum(axis=1, dtype=np.int32)
+
+    def first_active(self):
+        """Position of each patient's first active period.
+        """
+        return self.bits().argmax(axis=1).astype(np.int32)
+
+    def repeat_users(self, min_months=2):
+        """Number of patients active in at least `min_months` periods.
+        """
+        return int(np.count_nonzero(self.months_active() >= min_months))
+
+    def active_k_of_last_n(self, k, n, end_date=None):
+        """Number of patients active in at least `k` of the `n` periods up to
+        and including `end_date` (the latest period by default).
+        """
+        stop = len(self.periods) if end_date is None else self.period_index(end_date) + 1
+        counts = self.months_active(max(stop - n, 0), stop)
+        return int(np.count_nonzero(counts >= k))
+
+    def retention(self):
+        """Month-over-month retention: of the patients active in each period,
+        how many are active again in the next one.
+        """
+        bits = self.bits()
+        active = bits.sum(axis=0, dtype=np.int64)
+        # the last period has no next period to be retained into
+        retained = np.append((bits[:, :-1] & bits[:, 1:]).sum(axis=0, dtype=np.int64), np.nan)
+        df = pd.DataFrame({"date": self.periods, "active": active, "retained": retained})
+        df['retention'] = df['retained'] / df['active'].where(df['active'] > 0)
+        return df
+
+    def first_use_cohorts(self):
+        """Patients active in each period, by the period of their first use.
+        Returns a tidy table of cohort, date, months_since_first_use and active.
+        """
+        first = self.first_active()
+        n_periods = len(self.periods)
+        # one bincount over every active (first period, period) pair
+        patient, period = np.nonzero(self.bits())
+        counts = np.bincount(first[patient].astype(np.int64) * n_periods + period,
+                             minlength=n_periods * n_periods).reshape(n_periods, n_periods)
+
+        cohort, period = np.nonzero(np.triu(np.ones_like(counts, dtype=bool)))
+        return pd.DataFrame({
+            "cohort": self.periods[cohort],
+            "date": self.periods[period],
+            "months_since_first_use": period - cohort,
+            "active": counts[cohort, period],
+        })
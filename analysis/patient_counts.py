@@ -0,0 +1,315 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+
+INPUT_DIR = 'output'
+INPUT_PREFIX = 'input_measures_bycode_2'
+STORE_DIR = os.path.join('output', 'patient_count')
+MANIFEST = 'manifest.json'
+
+# 2**12 one-byte registers per month: ~4KB, standard error 1.04/sqrt(4096) ~ 1.6%
+HLL_PRECISION = 12
+
+SCAN_COLUMNS = {'patient_id': 'int64', 'event_x': 'int8'}
+CHUNKSIZE = 1_000_000
+
+
+def list_monthly_inputs(input_dir=INPUT_DIR, prefix=INPUT_PREFIX):
+    """Returns {date: path} for every monthly cohort file, sorted by date.
+    `input_dir` may also be a date-partitioned parquet dataset written by
+    columnar.py.
+    """
+    if any(entry.startswith('date=') for entry in os.listdir(input_dir)):
+        from columnar import list_partitions
+        return list_partitions(input_dir)
+    inputs = {}
+    for file in os.listdir(input_dir):
+        if file.startswith(prefix) and file.endswith('.csv'):
+            date = file.split('_')[-1][:-4]
+            inputs[date] = os.path.join(input_dir, file)
+    return dict(sorted(inputs.items()))
+
+
+def file_hash(path, block_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def file_stat(path):
+    stat = os.stat(path)
+    return {"path": path, "size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+
+def as_id_array(ids):
+    """Sorted, de-duplicated ids in the smallest unsigned dtype that holds them.
+    """
+    ids = np.unique(np.asarray(ids, dtype=np.int64))
+    if len(ids) and ids[0] < 0:
+        raise ValueError("patient ids must be non-negative")
+    dtype = np.uint32 if len(ids) == 0 or ids[-1] < 2**32 else np.uint64
+    return ids.astype(dtype)
+
+
+def scan_dtype(schema=None):
+    """dtypes of the scanned columns, taken from the study's schema (see
+    schema.py) where one is given.
+    """
+    if schema is None:
+        return SCAN_COLUMNS
+    return {c: schema.dtype.get(c, t) for c, t in SCAN_COLUMNS.items()}
+
+
+def read_patient_ids(path, chunksize=CHUNKSIZE, dtype=SCAN_COLUMNS):
+    """Ids of patients with `event_x` in one monthly file, reading only the
+    columns needed, in chunks.
+    """
+    if path.endswith('.parquet'):
+        from columnar import read_columns
+        chunks = [read_columns(path, list(dtype), dtype)]
+    else:
+        chunks = pd.read_csv(path, usecols=list(dtype), dtype=dtype, chunksize=chunksize)
+    ids = []
+    for chunk in chunks:
+        # event_x may be a nullable Int8 from the schema: missing is no event
+        event = chunk['event_x'].eq(1).to_numpy(dtype=bool, na_value=False)
+        ids.append(np.unique(chunk['patient_id'].to_numpy()[event]))
+    return as_id_array(np.concatenate(ids) if ids else [])
+
+
+def scan_inputs(inputs, workers=1, chunksize=CHUNKSIZE, dtype=SCAN_COLUMNS):
+    """Reads {date: path} into {date: ids}, spreading files over `workers`
+    processes. Results are returned in date order.
+    """
+    dates = sorted(inputs)
+    paths = [inputs[date] for date in dates]
+    if workers <= 1 or len(paths) <= 1:
+        results = [read_patient_ids(path, chunksize, dtype) for path in paths]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(read_patient_ids, paths, [chunksize] * len(paths),
+                                    [dtype] * len(paths)))
+    return dict(zip(dates, results))
+
+
+def _hash64(ids):
+    """splitmix64 finaliser, so that sequential pseudo ids spread evenly
+    over the sketch registers.
+    """
+    h = np.asarray(ids, dtype=np.uint64).copy()
+    h ^= h >> np.uint64(30)
+    h *= np.uint64(0xbf58476d1ce4e5b9)
+    h ^= h >> np.uint64(27)
+    h *= np.uint64(0x94d049bb133111eb)
+    h ^= h >> np.uint64(31)
+    return h
+
+
+def _bit_length(w):
+    n = np.zeros(w.shape, dtype=np.uint8)
+    for shift in (32, 16, 8, 4, 2, 1):
+        high = w >= np.uint64(1 << shift)
+        n[high] += shift
+        w = np.where(high, w >> np.uint64(shift), w)
+    return n + (w > 0)
+
+
+def hll_sketch(ids, precision=HLL_PRECISION):
+    """HyperLogLog registers (uint8, length 2**precision) for a set of ids.
+    Sketches of different months merge with `hll_merge`.
+    """
+    h = _hash64(ids)
+    index = (h >> np.uint64(64 - precision)).astype(np.int64)
+    rest = h & np.uint64((1 << (64 - precision)) - 1)
+    rank = (64 - precision + 1 - _bit_length(rest)).astype(np.uint8)
+    registers = np.zeros(1 << precision, dtype=np.uint8)
+    np.maximum.at(registers, index, rank)
+    return registers
+
+
+def hll_merge(sketches):
+    return np.maximum.reduce([np.asarray(s) for s in sketches])
+
+
+def hll_estimate(registers):
+    """Distinct count estimate from HyperLogLog registers, with the linear
+    counting correction for small cardinalities. The relative standard error
+    is `hll_error(precision)`.
+    """
+    m = len(registers)
+    alpha = 0.7213 / (1 + 1.079 / m)
+    estimate = alpha * m * m / np.sum(np.ldexp(1.0, -registers.astype(np.int64)))
+    empty = np.count_nonzero(registers == 0)
+    if estimate <= 2.5 * m and empty:
+        estimate = m * np.log(m / empty)
+    return int(round(estimate))
+
+
+def hll_error(precision=HLL_PRECISION):
+    return 1.04 / np.sqrt(1 << precision)
+
+
+def load_manifest(store_dir=STORE_DIR):
+    path = os.path.join(store_dir, MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)['months']
+
+
+def save_manifest(months, store_dir=STORE_DIR):
+    path = os.path.join(store_dir, MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({"months": months}, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def month_path(date, store_dir=STORE_DIR):
+    return os.path.join(store_dir, f'{date}.npy')
+
+
+def sketch_path(date, store_dir=STORE_DIR):
+    return os.path.join(store_dir, f'{date}.hll.npy')
+
+
+def _save_array(path, array):
+    with open(path + '.tmp', 'wb') as f:
+        np.save(f, array)
+    os.replace(path + '.tmp', path)
+
+
+def save_month(date, ids, store_dir=STORE_DIR, precision=HLL_PRECISION):
+    _save_array(month_path(date, store_dir), ids)
+    _save_array(sketch_path(date, store_dir), hll_sketch(ids, precision))
+
+
+def stale_months(inputs, manifest):
+    """Returns {date: sha256} for input files that are new or have changed
+    since they were last processed, updating `manifest` in place for files
+    that were only touched (new size/mtime but identical content).
+    """
+    stale = {}
+    for date, path in inputs.items():
+        stat = file_stat(path)
+        entry = manifest.get(date)
+        if entry is not None and all(entry[k] == stat[k] for k in stat):
+            continue
+        digest = file_hash(path)
+        if entry is not None and entry['sha256'] == digest:
+            entry.update(stat)
+            continue
+        stale[date] = digest
+    return stale
+
+
+def update_store(input_dir=INPUT_DIR, store_dir=STORE_DIR, prefix=INPUT_PREFIX, workers=1,
+                 dtype=SCAN_COLUMNS):
+    """Brings the binary patient id store in line with the monthly inputs,
+    only parsing files that are new or changed. Returns the dates rebuilt.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    inputs = list_monthly_inputs(input_dir, prefix)
+    manifest = load_manifest(store_dir)
+
+    stale = stale_months(inputs, manifest)
+    scanned = scan_inputs({date: inputs[date] for date in stale}, workers, dtype=dtype)
+    for date, ids in scanned.items():
+        path = inputs[date]
+        digest = stale[date]
+        save_month(date, ids, store_dir)
+        manifest[date] = {**file_stat(path), "sha256": digest,
+                          "count": int(len(ids)), "dtype": ids.dtype.name,
+                          "hll_precision": HLL_PRECISION}
+
+    # sketches for months stored before sketches were kept
+    for date, entry in manifest.items():
+        if entry.get("hll_precision") != HLL_PRECISION and date in inputs:
+            ids = np.load(month_path(date, store_dir))
+            _save_array(sketch_path(date, store_dir), hll_sketch(ids))
+            entry["hll_precision"] = HLL_PRECISION
+
+    # months whose input has gone are dropped, as a full rebuild would
+    for date in set(manifest) - set(inputs):
+        del manifest[date]
+        for path in (month_path(date, store_dir), sketch_path(date, store_dir)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    save_manifest(manifest, store_dir)
+    return list(stale)
+
+
+def load_patient_ids(store_dir=STORE_DIR, mmap=True):
+    """Returns {date: sorted id array} from the store, memory-mapped by default.
+    """
+    mmap_mode = 'r' if mmap else None
+    return {date: np.load(month_path(date, store_dir), mmap_mode=mmap_mode)
+            for date in sorted(load_manifest(store_dir))}
+
+
+def load_sketches(store_dir=STORE_DIR):
+    """Returns {date: HyperLogLog registers} from the store.
+    """
+    return {date: np.load(sketch_path(date, store_dir))
+            for date in sorted(load_manifest(store_dir))}
+
+
+class LastSeenIndex:
+    """Last month each patient was seen, built once from {date: ids}.
+
+    `patient_ids` is the sorted dense index of patients and `last_seen` the
+    last period each was seen in. Because every window asked of it is
+    trailing (it ends at the latest period), the distinct count for any
+    window is one `searchsorted` on the sorted `last_seen` values.
+    """
+
+    def __init__(self, num_patients):
+        dates = sorted(num_patients)
+        periods = np.array(dates, dtype='datetime64[D]')
+        months = [np.asarray(num_patients[date], dtype=np.uint64) for date in dates]
+        ids = np.concatenate(months) if months else np.array([], dtype=np.uint64)
+        period_index = np.repeat(np.arange(len(dates)), [len(m) for m in months])
+
+        order = np.lexsort((period_index, ids))
+        ids, period_index = ids[order], period_index[order]
+        last = np.ones(len(ids), dtype=bool)
+        last[:-1] = ids[1:] != ids[:-1]
+
+        self.periods = periods
+        self.patient_ids = ids[last]
+        self.last_seen = periods[period_index[last]]
+        self._sorted_last_seen = np.sort(self.last_seen)
+
+    def __len__(self):
+        return len(self.patient_ids)
+
+    def count_seen_after(self, cutoffs):
+        """Distinct patients seen in any period strictly after each cutoff date.
+        """
+        cutoffs = np.asarray(cutoffs, dtype='datetime64[D]')
+        return len(self) - np.searchsorted(self._sorted_last_seen, cutoffs, side='right')
+
+    def trailing_counts(self, end_date, months=(1, 3, 6, 12)):
+        """Distinct patients over the whole period and the trailing `months`
+        windows before `end_date`, as {"total": n, "months_<k>": n, ...}.
+        """
+        end_date = np.datetime64(end_date, 'D')
+        end_month = end_date.astype('datetime64[M]')
+        day = end_date - end_month.astype('datetime64[D]')
+        cutoffs = []
+        for k in months:
+            # clamp to the last day of the month, as relativedelta does
+            start = end_month - np.timedelta64(k, 'M')
+            month_end = (start + np.timedelta64(1, 'M')).astype('datetime64[D]') - np.timedelta64(1, 'D')
+            cutoffs.append(min(start.astype('datetime64[D]') + day, month_end))
+        counts = self.count_seen_after(cutoffs)
+        result = {"total": len(self)}
+        result.update({f"months_{k}": int(n) for k, n in zip(months, counts)})
+        return result
@@ -0,0 +1,197 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from columnar import COLUMNAR_DIR, read_table, write_table
+from registration import RegistrationIndex, _find
+
+
+SNAPSHOT_DIR = os.path.join(COLUMNAR_DIR, 'snapshot')
+PATIENTS_FILE = os.path.join('output', 'input_snapshot.csv')
+STATIC_COLUMNS = ['sex', 'ethnicity', 'index_of_multiple_deprivation']
+SPELL_COLUMNS = ['practice', 'stp', 'region']
+
+
+def _days(values):
+    """Dates ('YYYY-MM' or 'YYYY-MM-DD', '' or NaN for none) as datetime64[D].
+    """
+    return pd.to_datetime(pd.Series(values).replace('', None), format='mixed').to_numpy().astype('datetime64[D]')
+
+
+def read_patients(path=PATIENTS_FILE):
+    """The once-off output of study_definition_snapshot: date of birth (as
+    the first of its month), sex, latest ethnicity, IMD rank and date of
+    death, sorted by patient_id.
+    """
+    df = pd.read_csv(path, dtype={'patient_id': 'int64', 'sex': 'category', 'ethnicity': 'category'},
+                     keep_default_na=False, na_values={'index_of_multiple_deprivation': ['']})
+    df['date_of_birth'] = _days(df['date_of_birth'])
+    df['date_of_death'] = _days(df['date_of_death'])
+    return df.sort_values('patient_id', ignore_index=True)
+
+
+def spells_from_cohorts(inputs):
+    """Registration spells from per-date cohort files ({index date: path}),
+    for when no spell-level extract is available: consecutive index dates on
+    which a patient is at the same practice form one spell, from the first
+    of them to the last.
+    """
+    frames = []
+    for date, path in sorted(inputs.items()):
+        df = pd.read_csv(path, usecols=['patient_id'] + SPELL_COLUMNS,
+                         dtype={'patient_id': 'int64', 'practice': 'int32', 'stp': str, 'region': str},
+                         keep_default_na=False)
+        df['index'] = len(frames)
+        df['date'] = np.datetime64(date, 'D')
+        frames.append(df)
+    df = pd.concat(frames, ignore_index=True).sort_values(['patient_id', 'index'], ignore_index=True)
+
+    patient = df['patient_id'].to_numpy()
+    index = df['index'].to_numpy()
+    practice = df['practice'].to_numpy()
+    new_spell = np.r_[True, (patient[1:] != patient[:-1]) | (practice[1:] != practice[:-1])
+                      | (index[1:] != index[:-1] + 1)]
+    last = np.r_[np.flatnonzero(new_spell)[1:] - 1, len(df) - 1]
+    spells = df.loc[new_spell, ['patient_id'] + SPELL_COLUMNS].reset_index(drop=True)
+    spells['start_date'] = df['date'].to_numpy()[new_spell]
+    spells['end_date'] = df['date'].to_numpy()[last]
+    return spells
+
+
+def read_spells(path):
+    """A spell-level extract: patient_id, start_date, end_date ('' while
+    still registered), practice, stp and region.
+    """
+    df = pd.read_csv(path, dtype={'patient_id': 'int64', 'practice': 'int32', 'stp': str, 'region': str},
+                     keep_default_na=False)
+    df['start_date'] = _days(df['start_date'])
+    df['end_date'] = _days(df['end_date'])
+    return df
+
+
+def build_snapshot(patients, spells, snapshot_dir=SNAPSHOT_DIR):
+    """Writes the snapshot: patients sorted by patient_id and spells sorted
+    by patient_id and start date, as parquet.
+    """
+    import pyarrow as pa
+    spells = spells.sort_values(['patient_id', 'start_date'], ignore_index=True)
+    write_table(pa.Table.from_pandas(patients, preserve_index=False),
+                os.path.join(snapshot_dir, 'patients.parquet'))
+    write_table(pa.Table.from_pandas(spells, preserve_index=False),
+                os.path.join(snapshot_dir, 'spells.parquet'))
+    return snapshot_dir
+
+
+class PatientSnapshot:
+    """Static patient attributes and registration spells, both sorted by
+    patient_id, so that attributes for any set of patients and any index
+    date are looked up with searchsorted rather than a hash join.
+    """
+
+    def __init__(self, patients, spells):
+        self.patients = patients.sort_values('patient_id', ignore_index=True)
+        self.registration = RegistrationIndex(spells, self.patients[['patient_id', 'date_of_death']])
+        self.spells = self.registration.spells
+        self.patient_ids = self.patients['patient_id'].to_numpy()
+        self.date_of_birth = self.patients['date_of_birth'].to_numpy().astype('datetime64[D]')
+        self.date_of_death = self.patients['date_of_death'].to_numpy().astype('datetime64[D]')
+
+    @classmethod
+    def load(cls, snapshot_dir=SNAPSHOT_DIR):
+        patients = read_table(os.path.join(snapshot_dir, 'patients.parquet'))
+        spells = read_table(os.path.join(snapshot_dir, 'spells.parquet'))
+        for c in ('sex', 'ethnicity'):
+            patients[c] = patients[c].astype('category')
+        for c in ('stp', 'region'):
+            spells[c] = spells[c].astype('category')
+        return cls(patients, spells)
+
+    def positions(self, patient_ids):
+        """Row of each patient in `patients`, -1 where not in the snapshot.
+        """
+        return _find(self.patient_ids, np.asarray(patient_ids, dtype=np.int64))
+
+    def spell_at(self, patient_ids, index_date):
+        """Spell each patient is registered in on `index_date` (the latest
+        starting one on or before it), -1 where none is current.
+        """
+        return self.registration.spell_at([index_date], patient_ids)[:, 0]
+
+    def age_at(self, positions, index_date):
+        """Age in whole years on `index_date`, as age_as_of: the date of birth
+        is the first of its month.
+        """
+        date = np.datetime64(index_date, 'D')
+        dob = self.date_of_birth[positions]
+        born = dob.astype('datetime64[M]').astype(np.int64)
+        now = date.astype('datetime64[M]').astype(np.int64)
+        return (now // 12 - born // 12) - (now % 12 < born % 12)
+
+    def population(self, index_date):
+        """Patients registered and alive on `index_date`, with their static
+        attributes, age and practice/stp/region on that date, sorted by
+        patient_id. Further population criteria of a study (such as
+        `age_ != 0`) are left to the caller.
+        """
+        date = np.datetime64(index_date, 'D')
+        spell = self.spell_at(self.patient_ids, date)
+        alive = np.isnat(self.date_of_death) | (self.date_of_death > date)
+        positions = np.flatnonzero((spell >= 0) & alive)
+        spell = spell[positions]
+
+        df = pd.DataFrame({'patient_id': self.patient_ids[positions]})
+        df['age'] = self.age_at(positions, date).astype(np.int16)
+        for c in STATIC_COLUMNS:
+            df[c] = self.patients[c].iloc[positions].reset_index(drop=True)
+        for c in SPELL_COLUMNS:
+            df[c] = self.spells[c].iloc[spell].reset_index(drop=True)
+        return df
+
+
+def join_period(population, activity, count_columns=None):
+    """Joins a period's activity table (patient_id and counts, only for
+    patients with events) onto its population. Both are sorted by
+    patient_id, so the join is a searchsorted merge; patients with no events
+    get zero counts and events of patients outside the population are
+    dropped, as generate_cohort's population filter does.
+    """
+    count_columns = [c for c in activity.columns if c != 'patient_id'] \
+        if count_columns is None else count_columns
+    pos = _find(activity['patient_id'].to_numpy(), population['patient_id'].to_numpy())
+    matched = pos >= 0
+    df = population.copy()
+    for c in count_columns:
+        values = activity[c].to_numpy()
+        column = np.zeros(len(df), dtype=values.dtype)
+        column[matched] = values[pos[matched]]
+        df[c] = column
+    return df
+
+
+def join_periods(snapshot, results):
+    """join_period for every {period start: activity} of count_events or
+    pivot_events, with each period's population on its start date.
+    """
+    return {period: join_period(snapshot.population(period), activity)
+            for period, activity in results.items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Build the per-patient attribute snapshot joined to every period')
+    parser.add_argument('--patients', default=PATIENTS_FILE)
+    parser.add_argument('--spells', help='spell-level extract; by default spells are '
+                                         'collapsed from the per-date cohort files')
+    parser.add_argument('--cohort-dir', default=os.path.join('output', 'measures'))
+    parser.add_argument('--cohort-prefix', default='input_measures_bycode')
+    parser.add_argument('--snapshot-dir', default=SNAPSHOT_DIR)
+    args = parser.parse_args()
+
+    if args.spells:
+        spells = read_spells(args.spells)
+    else:
+        from patient_counts import list_monthly_inputs
+        spells = spells_from_cohorts(list_monthly_inputs(args.cohort_dir, args.cohort_prefix))
+    build_snapshot(read_patients(args.patients), spells, args.snapshot_dir)
@@ -0,0 +1,164 @@
+import argparse
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+
+
+COMPRESSION = 200
+CHUNKSIZE = 1_000_000
+SKETCH_DIR = os.path.join('output', 'quantile_sketches')
+
+
+class TDigest:
+    """Mergeable t-digest of a stream of values.
+
+    Centroids are kept sorted by mean. Each update sorts the new values in
+    with the existing centroids and re-clusters them in one vectorised pass,
+    using the k1 scale function so clusters stay small in the tails, where
+    the outer percentiles are read from.
+    """
+
+    def __init__(self, means=None, weights=None, minimum=np.inf, maximum=-np.inf,
+                 compression=COMPRESSION):
+        self.means = np.array([], dtype=float) if means is None else np.asarray(means, dtype=float)
+        self.weights = np.array([], dtype=float) if weights is None else np.asarray(weights, dtype=float)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.compression = compression
+
+    @property
+    def count(self):
+        return self.weights.sum()
+
+    def _compress(self, means, weights):
+        order = np.argsort(means, kind='stable')
+        means, weights = means[order], weights[order]
+        total = weights.sum()
+        q_left = (np.cumsum(weights) - weights) / total
+        k = self.compression / (2 * np.pi) * np.arcsin(2 * q_left - 1)
+        cluster = np.floor(k - k[0]).astype(np.int64)
+        cluster = np.unique(cluster, return_inverse=True)[1]
+        w = np.bincount(cluster, weights=weights)
+        self.means = np.bincount(cluster, weights=means * weights) / w
+        self.weights = w
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return self
+        self.minimum = min(self.minimum, values.min())
+        self.maximum = max(self.maximum, values.max())
+        self._compress(np.concatenate((self.means, values)),
+                       np.concatenate((self.weights, np.ones(len(values)))))
+        return self
+
+    def merge(self, other):
+        if not len(other.weights):
+            return self
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+        self._compress(np.concatenate((self.means, other.means)),
+                       np.concatenate((self.weights, other.weights)))
+        return self
+
+    def quantile(self, q):
+        """Estimated quantiles, interpolating linearly between centroid
+        centres (and the exact minimum and maximum at the ends).
+        """
+        q = np.asarray(q, dtype=float)
+        if not len(self.weights):
+            return np.full(q.shape, np.nan)
+        total = self.count
+        centres = np.cumsum(self.weights) - self.weights / 2
+        x = np.concatenate(([0], centres, [total]))
+        y = np.concatenate(([self.minimum], self.means, [self.maximum]))
+        return np.interp(q * total, x, y)
+
+
+def digest_measure_file(path, column='value', period_column='date',
+                        chunksize=CHUNKSIZE, digests=None):
+    """Updates {period: TDigest} with the `column` values of a measure file,
+    reading it chunk by chunk.
+    """
+    digests = {} if digests is None else digests
+    for chunk in pd.read_csv(path, usecols=[period_column, column],
+                             dtype={period_column: str, column: float},
+                             chunksize=chunksize):
+        for period, values in chunk.groupby(period_column)[column]:
+            digests.setdefault(period, TDigest()).update(values.to_numpy())
+    return digests
+
+
+def merge_digests(shards):
+    """Merges a list of {period: TDigest}, e.g. one per input shard.
+    """
+    merged = {}
+    for digests in shards:
+        for period, digest in digests.items():
+            merged.setdefault(period, TDigest(compression=digest.compression)).merge(digest)
+    return merged
+
+
+def save_digests(digests, path):
+    periods = sorted(digests)
+    sizes = [len(digests[p].weights) for p in periods]
+    np.savez_compressed(
+        path,
+        periods=np.array(periods, dtype=str),
+        offsets=np.concatenate(([0], np.cumsum(sizes))).astype(np.int64),
+        means=np.concatenate([digests[p].means for p in periods]) if periods else [],
+        weights=np.concatenate([digests[p].weights for p in periods]) if periods else [],
+        minimum=np.array([digests[p].minimum for p in periods]),
+        maximum=np.array([digests[p].maximum for p in periods]),
+        compression=np.array([digests[p].compression for p in periods]),
+    )
+
+
+def load_digests(path):
+    with np.load(path) as f:
+        offsets = f['offsets']
+        return {
+            str(period): TDigest(f['means'][start:stop], f['weights'][start:stop],
+                                 minimum, maximum, int(compression))
+            for period, start, stop, minimum, maximum, compression in zip(
+                f['periods'], offsets[:-1], offsets[1:],
+                f['minimum'], f['maximum'], f['compression'])
+        }
+
+
+def digest_percentiles(digests, quantiles, period_column='date', column='value'):
+    """Tidy period/percentile/value table, in the layout `add_percentiles`
+    returns.
+    """
+    periods = sorted(digests)
+    quantiles = np.asarray(quantiles)
+    values = [digests[p].quantile(quantiles) for p in periods]
+    return pd.DataFrame({
+        period_column: np.repeat(periods, len(quantiles)),
+        "percentile": np.tile(np.rint(quantiles * 100).astype(int), len(periods)),
+        column: np.concatenate(values) if values else [],
+    })
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Build per-period t-digests of practice-level measure values')
+    parser.add_argument('--input-files', default='output/measures/measure_*_practice.csv')
+    parser.add_argument('--output-dir', default=SKETCH_DIR)
+    parser.add_argument('--column', default='value')
+    parser.add_argument('--chunksize', type=int, default=CHUNKSIZE)
+    parser.add_argument('--append', action='store_true',
+                        help='merge into existing sketches, for inputs split across shards')
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    for path in sorted(glob.glob(args.input_files)):
+        name = os.path.splitext(os.path.basename(path))[0]
+        target = os.path.join(args.output_dir, f'{name}.npz')
+        digests = digest_measure_file(path, args.column, chunksize=args.chunksize)
+        if args.append and os.path.exists(target):
+            digests = merge_digests([load_digests(target), digests])
+        save_digests(digests, target)
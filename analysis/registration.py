@@ -0,0 +1,188 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+
+NO_END = np.datetime64('9999-12-31')
+# patients per block of the N x D queries: each intermediate array is
+# PATIENT_CHUNK x D, rather than N x D for a national population
+PATIENT_CHUNK = 100_000
+
+
+def _find(sorted_ids, ids):
+    # position of each of `ids` in `sorted_ids`, -1 where absent
+    pos = np.searchsorted(sorted_ids, ids)
+    found = pos < len(sorted_ids)
+    found[found] = sorted_ids[pos[found]] == ids[found]
+    return np.where(found, pos, -1)
+
+
+def patient_date_key(patient_ids, dates):
+    """(patient, date) as one sortable int64, for searchsorted over rows
+    sorted by id then date: days since 1970 take 17 bits once offset,
+    covering the years 1791 to 2149. Any non-negative int id will do.
+    """
+    days = np.asarray(dates, dtype='datetime64[D]').astype(np.int64)
+    return (np.asarray(patient_ids, dtype=np.int64) << 17) + days + (1 << 16)
+
+
+def _as_dates(dates):
+    return np.atleast_1d(np.asarray(dates, dtype='datetime64[D]'))
+
+
+class RegistrationIndex:
+    """Registration spells sorted by patient and start date, keyed as one
+    int64 per spell, with each patient's date of death.
+
+    Every query takes N patients and D dates and answers for all N x D pairs
+    with one searchsorted, as registered_as_of, registered_practice_as_of
+    and died_from_any_cause would per index date. Where spells overlap, the
+    latest starting one that covers the date is the current one, so an
+    ended later spell does not hide an earlier one still open.
+    """
+
+    def __init__(self, spells, deaths=None):
+        """`spells` has patient_id, start_date, end_date (NaT while still
+        registered) and practice, plus any other per-spell columns (stp,
+        region); `deaths` has patient_id and date_of_death (NaT if alive).
+        """
+        self.spells = spells.sort_values(['patient_id', 'start_date'], kind='stable', ignore_index=True)
+        self.spell_patient = self.spells['patient_id'].to_numpy(dtype=np.int64)
+        self.spell_start = self.spells['start_date'].to_numpy().astype('datetime64[D]')
+        end = self.spells['end_date'].to_numpy().astype('datetime64[D]')
+        self.spell_end = np.where(np.isnat(end), NO_END, end)
+        self.spell_practice = self.spells['practice'].to_numpy()
+        self.practices, self.spell_practice_code = np.unique(self.spell_practice, return_inverse=True)
+        self.spell_key = patient_date_key(self.spell_patient, self.spell_start)
+        # latest end of the patient's spells up to and including each one:
+        # no spell at or before a position covers dates past its reach
+        self.spell_reach = pd.Series(self.spell_end).groupby(self.spell_patient).cummax().to_numpy()
+
+        self.patient_ids = np.unique(self.spell_patient)
+        self.date_of_death = np.full(len(self.patient_ids), np.datetime64('NaT'), dtype='datetime64[D]')
+        if deaths is not None:
+            pos = _find(self.patient_ids, deaths['patient_id'].to_numpy(dtype=np.int64))
+            dod = deaths['date_of_death'].to_numpy().astype('datetime64[D]')
+            self.date_of_death[pos[pos >= 0]] = dod[pos >= 0]
+
+    def _patients(self, patient_ids):
+        return self.patient_ids if patient_ids is None else np.asarray(patient_ids, dtype=np.int64)
+
+    def _chunks(self, patient_ids):
+        for start in range(0, len(patient_ids), PATIENT_CHUNK):
+            yield slice(start, start + PATIENT_CHUNK)
+
+    def _current_spell(self, dates, patient_ids):
+        # spell_at, -1 also where the patient has died on or before the date
+        spell = self.spell_at(dates, patient_ids)
+        return np.where(self.alive_at(dates, patient_ids), spell, -1)
+
+    def _last_started(self, dates, patient_ids):
+        # N x D position of the patient's latest spell starting on or before
+        # the date, -1 where there is none
+        keys = patient_date_key(patient_ids[:, None], dates[None, :])
+        last = np.searchsorted(self.spell_key, keys, 'right') - 1
+        found = (last >= 0) & (self.spell_patient[np.maximum(last, 0)] == patient_ids[:, None])
+        return np.where(found, last, -1)
+
+    def spell_at(self, dates, patient_ids=None):
+        """N x D spell positions (rows of `spells`), -1 where the patient has
+        no current spell on the date.
+        """
+        patient_ids = self._patients(patient_ids)
+        spell = self._last_started(_as_dates(dates), patient_ids)
+        dates = np.broadcast_to(_as_dates(dates)[None, :], spell.shape)
+        # a spell covers the date unless it ended before it; walk back past
+        # ended spells while an earlier one of the patient still reaches it
+        pending = (spell >= 0) & (self.spell_reach[np.maximum(spell, 0)] >= dates)
+        result = np.full(spell.shape, -1, dtype=np.int64)
+        while pending.any():
+            pos = spell[pending]
+            covers = self.spell_end[pos] >= dates[pending]
+            result[pending] = np.where(covers, pos, -1)
+            spell[pending] = np.where(covers, pos, pos - 1)
+            pending[pending] = ~covers
+        return result
+
+    def alive_at(self, dates, patient_ids=None):
+        """N x D: not died on or before the date.
+        """
+        patient_ids = self._patients(patient_ids)
+        pos = _find(self.patient_ids, patient_ids)
+        dod = np.where(pos >= 0, self.date_of_death[np.maximum(pos, 0)], np.datetime64('NaT'))
+        return np.isnat(dod)[:, None] | (dod[:, None] > _as_dates(dates)[None, :])
+
+    def registered_at(self, dates, patient_ids=None):
+        """N x D: registered and alive on the date.
+        """
+        patient_ids, dates = self._patients(patient_ids), _as_dates(dates)
+        registered = np.zeros((len(patient_ids), len(dates)), dtype=bool)
+        for rows in self._chunks(patient_ids):
+            registered[rows] = self._current_spell(dates, patient_ids[rows]) >= 0
+        return registered
+
+    def practice_at(self, dates, patient_ids=None):
+        """N x D practice of the current spell, -1 where not registered and
+        alive on the date.
+        """
+        patient_ids, dates = self._patients(patient_ids), _as_dates(dates)
+        practice = np.full((len(patient_ids), len(dates)), -1, dtype=self.spell_practice.dtype)
+        for rows in self._chunks(patient_ids):
+            spell = self._current_spell(dates, patient_ids[rows])
+            practice[rows] = np.where(spell >= 0, self.spell_practice[np.maximum(spell, 0)], -1)
+        return practice
+
+    def registered_with_one_practice_between(self, start_date, end_date, patient_ids=None):
+        """Registered in one spell from start_date through end_date, as the
+        cohortextractor function (no check of death, as there).
+        """
+        spell = self._last_started(_as_dates(start_date), self._patients(patient_ids))[:, 0]
+        return (spell >= 0) & (self.spell_reach[np.maximum(spell, 0)] >= np.datetime64(end_date, 'D'))
+
+    def denominators(self, dates, patient_ids=None):
+        """Registered-and-alive patients per date and practice, as a tidy
+        frame (date, practice, population). Patients are counted
+        PATIENT_CHUNK at a time, so memory does not grow with the population.
+        """
+        patient_ids, dates = self._patients(patient_ids), np.unique(_as_dates(dates))
+        n_practices = len(self.practices)
+        counts = np.zeros(len(dates) * n_practices, dtype=np.int64)
+        # one bincount of (date, practice) per block of patients
+        for rows in self._chunks(patient_ids):
+            spell = self._current_spell(dates, patient_ids[rows])
+            column = np.broadcast_to(np.arange(len(dates)), spell.shape)[spell >= 0]
+            code = self.spell_practice_code[spell[spell >= 0]]
+            counts += np.bincount(column * n_practices + code, minlength=len(counts))
+        date, practice = np.divmod(np.flatnonzero(counts), n_practices)
+        return pd.DataFrame({'date': dates[date].astype(str), 'practice': self.practices[practice],
+                             'population': counts[counts > 0]})
+
+
+def period_dates(start_date, end_date, calendar='month'):
+    """Start of every month, week (Mondays) or quarter from start_date to
+    end_date, the index dates of a run over that calendar.
+    """
+    from event_table import period_start
+    days = np.arange(np.datetime64(start_date, 'D'), np.datetime64(end_date, 'D') + 1)
+    return np.unique(period_start(days, calendar))
+
+
+if __name__ == '__main__':
+    from event_table import CALENDARS
+    from patient_snapshot import SNAPSHOT_DIR, PatientSnapshot
+
+    parser = argparse.ArgumentParser(
+        description='Registered-and-alive patients per practice for every period of a calendar')
+    parser.add_argument('--snapshot-dir', default=SNAPSHOT_DIR)
+    parser.add_argument('--calendar', choices=CALENDARS, default='month')
+    parser.add_argument('--start-date', default='2019-01-01')
+    parser.add_argument('--end-date', default='2021-03-28')
+    parser.add_argument('--output-file', default=os.path.join('output', 'denominators.csv'))
+    args = parser.parse_args()
+
+    index = PatientSnapshot.load(args.snapshot_dir).registration
+    dates = period_dates(args.start_date, args.end_date, args.calendar)
+    os.makedirs(os.path.dirname(args.output_file) or '.', exist_ok=True)
+    index.denominators(dates).to_csv(args.output_file, index=False)
@@ -0,0 +1,203 @@
+import argparse
+import glob
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import yaml
+
+from disclosure import KEY_COLUMNS, RATE, REDACTION_THRESHOLD
+
+
+CHUNKSIZE = 500_000
+SAMPLE_ROWS = 1000
+# flagged cells listed per file and column, beyond the counts
+MAX_LISTED = 20
+# group labels marking a row as the total of its block
+TOTAL_LABELS = {'total', 'all'}
+
+
+def moderately_sensitive_outputs(project_file='project.yaml'):
+    """Returns {action: [output glob, ...]} for the moderately_sensitive
+    outputs declared in project.yaml.
+    """
+    with open(project_file) as f:
+        project = yaml.safe_load(f)
+    outputs = {}
+    for name, action in (project.get('actions') or {}).items():
+        declared = (action.get('outputs') or {}).get('moderately_sensitive') or {}
+        outputs[name] = list(declared.values())
+    return outputs
+
+
+def expand_outputs(outputs, root='.'):
+    """Expands the output globs into (action, path) pairs for files that exist.
+    """
+    files = []
+    for action, patterns in outputs.items():
+        for pattern in patterns:
+            for path in sorted(glob.glob(os.path.join(root, pattern))):
+                files.append((action, path))
+    return files
+
+
+def _sample_columns(path):
+    """All columns, the numeric ones and the text label columns (besides
+    date), from a sample of the file's first rows.
+    """
+    sample = pd.read_csv(path, nrows=SAMPLE_ROWS)
+    columns = [c for c in sample.columns if not c.startswith('Unnamed')]
+    numeric = [c for c in columns if pd.api.types.is_numeric_dtype(sample[c])]
+    labels = [c for c in columns if c not in numeric and c != 'date']
+    return list(sample.columns), numeric, labels
+
+
+def _total_rows(chunk, labels):
+    # rows labelled as totals (e.g. a 'Total' group) rather than cells
+    if not labels:
+        return np.zeros(len(chunk), dtype=bool)
+    found = chunk[labels].apply(lambda s: s.astype(str).str.strip().str.lower().isin(TOTAL_LABELS))
+    return found.any(axis=1).to_numpy()
+
+
+def _block_sums(block, n, total_row):
+    """Per block: redacted (missing) cells, the sum of the cells shown and
+    the published total, if the block has a total row.
+    """
+    missing = np.isnan(n)
+    df = pd.DataFrame({
+        'block': block,
+        'redacted': missing & ~total_row,
+        'shown': np.where(missing | total_row, 0, n),
+        'total': np.where(total_row & ~missing, n, np.nan),
+    })
+    return df.groupby('block', sort=False).agg(
+        redacted=('redacted', 'sum'), shown=('shown', 'sum'), total=('total', lambda t: t.sum(min_count=1)))
+
+
+def back_calculable_blocks(sums, threshold=REDACTION_THRESHOLD):
+    """Blocks (e.g. dates) in which suppressed cells can be recovered: a
+    single redacted cell, which the block's total or complementary outputs
+    give back, or redacted cells whose sum follows from a published total
+    and is in 1..threshold.
+    """
+    derived = sums['total'] - sums['shown']
+    recoverable = (sums['redacted'] == 1) | (
+        (sums['redacted'] >= 1) & (derived >= 1) & (derived <= threshold))
+    return list(sums.index[recoverable.to_numpy()])
+
+
+def scan_file(path, threshold=REDACTION_THRESHOLD, chunksize=CHUNKSIZE):
+    """Scans one csv output for small counts.
+
+    Count columns are numeric, integer-valued columns that are not cell keys;
+    only they, the date and the text label columns are read.
+    Cells are flagged when a count is in 1..threshold, and blocks (each
+    date, or the whole file without one) when their suppressed cells can be
+    back-calculated, see `back_calculable_blocks`.
+    """
+    entry = {"path": path, "scanned": path.endswith('.csv')}
+    if not entry["scanned"]:
+        return entry
+
+    columns, numeric, labels = _sample_columns(path)
+    candidates = [c for c in numeric if c not in KEY_COLUMNS and c != RATE]
+    # only the counts, the date and the labels that mark total rows are
+    # read; at least one column, so that every row is still counted
+    usecols = candidates + labels + (['date'] if 'date' in columns else []) or columns[:1]
+
+    rows = 0
+    dates = []
+    integral = dict.fromkeys(candidates, True)
+    minimum = dict.fromkeys(candidates, np.inf)
+    flagged = {c: [] for c in candidates}
+    block_sums = {c: [] for c in candidates}
+
+    for chunk in pd.read_csv(path, usecols=usecols, dtype={c: str for c in labels}, chunksize=chunksize):
+        index = np.arange(rows, rows + len(chunk))
+        rows += len(chunk)
+        if 'date' in chunk.columns:
+            d = chunk['date'].dropna()
+            if len(d):
+                dates += [d.min(), d.max()]
+            block = chunk['date'].astype(str).to_numpy()
+        else:
+            block = np.full(len(chunk), '')
+        total_row = _total_rows(chunk, labels)
+
+        for c in candidates:
+            n = pd.to_numeric(chunk[c], errors='coerce').to_numpy(dtype=float)
+            present = ~np.isnan(n)
+            integral[c] &= bool(np.all(n[present] == np.round(n[present])))
+            positive = n[present & (n > 0)]
+            if len(positive):
+                minimum[c] = min(minimum[c], positive.min())
+            flagged[c].append(index[present & (n >= 1) & (n <= threshold)])
+            block_sums[c].append(_block_sums(block, n, total_row))
+
+    counts = [c for c in candidates if integral[c]]
+    flagged = {c: np.concatenate(flagged[c]) if flagged[c] else np.array([], int) for c in counts}
+    back_calculable = {}
+    for c in counts:
+        if block_sums[c]:
+            # blocks can span chunks
+            sums = pd.concat(block_sums[c]).groupby(level=0, sort=False).agg(
+                {'redacted': 'sum', 'shown': 'sum', 'total': lambda t: t.sum(min_count=1)})
+            blocks = back_calculable_blocks(sums, threshold)
+            if blocks:
+                back_calculable[c] = blocks
+    min_cell = min([minimum[c] for c in counts], default=np.inf)
+
+    entry.update({
+        "rows": rows,
+        "date_min": min(dates) if dates else None,
+        "date_max": max(dates) if dates else None,
+        "count_columns": counts,
+        "min_cell": None if np.isinf(min_cell) else float(min_cell),
+        "flagged_cells": {c: {"count": int(len(i)), "rows": i[:MAX_LISTED].tolist()}
+                          for c, i in flagged.items() if len(i)},
+        "back_calculable_blocks": {c: {"count": len(b), "blocks": b[:MAX_LISTED]}
+                                   for c, b in back_calculable.items()},
+    })
+    entry["ok"] = not entry["flagged_cells"] and not entry["back_calculable_blocks"]
+    return entry
+
+
+def scan_outputs(project_file='project.yaml', root='.', threshold=REDACTION_THRESHOLD, workers=1):
+    """Scans every moderately_sensitive output declared in project.yaml.
+    Returns a list of catalog entries, one per file.
+    """
+    files = expand_outputs(moderately_sensitive_outputs(project_file), root)
+    paths = [path for _, path in files]
+    if workers <= 1:
+        entries = [scan_file(path, threshold) for path in paths]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            entries = list(pool.map(scan_file, paths, [threshold] * len(paths),
+                                    chunksize=max(1, len(paths) // (4 * workers))))
+    for (action, _), entry in zip(files, entries):
+        entry["action"] = action
+    return entries
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Check moderately_sensitive outputs for small counts before release')
+    parser.add_argument('--project', default='project.yaml')
+    parser.add_argument('--root', default='.')
+    parser.add_argument('--threshold', type=int, default=REDACTION_THRESHOLD)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--output', default=os.path.join('output', 'release_catalog.json'))
+    args = parser.parse_args()
+
+    entries = scan_outputs(args.project, args.root, args.threshold, args.workers)
+    with open(args.output, 'w') as f:
+        json.dump({"threshold": args.threshold, "files": entries}, f, indent=2)
+
+    not_ok = [e["path"] for e in entries if e["scanned"] and not e["ok"]]
+    print(f'scanned {sum(e["scanned"] for e in entries)} of {len(entries)} files, '
+          f'{len(not_ok)} with small or back-calculable counts')
+    for path in not_ok:
+        print(f'  {path}')
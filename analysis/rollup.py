@@ -0,0 +1,152 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from measures_engine import list_inputs, load_measures
+from registration import _find
+
+
+GEOGRAPHY = ['stp', 'region']
+NATIONAL = 'national'
+
+
+def read_practices(path, date, levels=GEOGRAPHY):
+    """The practices of one cohort file with their `levels`, one row each.
+    """
+    columns = ['practice'] + list(levels)
+    dtype = dict({c: str for c in levels}, practice='int64')
+    if path.endswith('.parquet'):
+        from columnar import read_columns
+        df = read_columns(path, columns, dtype)
+    else:
+        df = pd.read_csv(path, usecols=columns, dtype=dtype, keep_default_na=False)
+    df = df.drop_duplicates('practice').sort_values('practice', ignore_index=True)
+    df.insert(0, 'date', date)
+    return df
+
+
+def practice_dimension(inputs, levels=GEOGRAPHY, workers=1):
+    """Practice -> stp, region (or other `levels`) for every {date: path} of
+    the monthly inputs, sorted by date and practice.
+    """
+    dates = list(inputs)
+    paths = [inputs[d] for d in dates]
+    all_levels = [levels] * len(dates)
+    if workers <= 1 or len(dates) <= 1:
+        frames = list(map(read_practices, paths, dates, all_levels))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            frames = list(pool.map(read_practices, paths, dates, all_levels))
+    return pd.concat(frames, ignore_index=True).sort_values(['date', 'practice'], ignore_index=True)
+
+
+def _date_practice_key(date_codes, practices):
+    return (np.asarray(date_codes, dtype=np.int64) << 32) + np.asarray(practices, dtype=np.int64)
+
+
+def attach_levels(df, dimension, levels=GEOGRAPHY):
+    """Adds the `levels` of each (date, practice) row of `df` from the
+    dimension table, with a searchsorted lookup; '' where the practice is
+    not in that month's dimension.
+    """
+    dates = np.unique(dimension['date'].to_numpy(dtype=str))
+    dimension_key = _date_practice_key(np.searchsorted(dates, dimension['date'].to_numpy(dtype=str)),
+                                       dimension['practice'])
+    date = df['date'].to_numpy(dtype=str)
+    date_code = np.searchsorted(dates, date)
+    known = (date_code < len(dates)) & (dates[np.minimum(date_code, len(dates) - 1)] == date)
+    pos = np.where(known, _find(dimension_key, _date_practice_key(date_code, df['practice'])), -1)
+    df = df.copy()
+    for level in levels:
+        values = dimension[level].to_numpy(dtype=object)
+        df[level] = np.where(pos >= 0, values[np.maximum(pos, 0)], '')
+    return df
+
+
+def rollup(df, dimension, numerator, denominator, levels=GEOGRAPHY):
+    """Sums a practice-level measure (date, practice, numerator,
+    denominator) up every level of the practice hierarchy and to the
+    national total, as grouping sets: each row is keyed once per level, and
+    the sums of all levels come from a single bincount.
+
+    Returns a tidy frame: level, unit, date, numerator, denominator, value,
+    with the practice rows as given.
+    """
+    df = attach_levels(df, dimension, levels)
+    dates, date_code = np.unique(df['date'].to_numpy(dtype=str), return_inverse=True)
+    sets = ['practice'] + list(levels) + [NATIONAL]
+
+    keys, units, offset = [], [], 0
+    for level in sets:
+        if level == NATIONAL:
+            codes, uniques = np.zeros(len(df), dtype=np.int64), np.array([NATIONAL], dtype=object)
+        else:
+            codes, uniques = pd.factorize(df[level].astype(str))
+        keys.append(offset + date_code * len(uniques) + codes)
+        units.append((level, uniques))
+        offset += len(dates) * len(uniques)
+    keys = np.concatenate(keys)
+
+    occupied = np.bincount(keys, minlength=offset) > 0
+    sums = {c: np.bincount(keys, weights=np.tile(df[c].to_numpy(dtype=float), len(sets)),
+                           minlength=offset)[occupied]
+            for c in (numerator, denominator)}
+
+    level_column, unit_column, date_column = [], [], []
+    for level, uniques in units:
+        level_column.append(np.full(len(dates) * len(uniques), level, dtype=object))
+        unit_column.append(np.tile(np.asarray(uniques, dtype=object), len(dates)))
+        date_column.append(np.repeat(dates, len(uniques)))
+    result = pd.DataFrame({'level': np.concatenate(level_column)[occupied],
+                           'unit': np.concatenate(unit_column)[occupied],
+                           'date': np.concatenate(date_column)[occupied]})
+    result[numerator] = sums[numerator]
+    result[denominator] = sums[denominator]
+    result['value'] = result[numerator] / result[denominator]
+    return result
+
+
+def write_rollup(result, output_dir, measure_id):
+    """Writes `measure_<id>_by_<level>.csv` for each level above practice
+    and `measure_<id>_national.csv`, in the layout of generate_measures (the
+    level's column, numerator, denominator, value, date).
+    """
+    outputs = []
+    for level, group in result.groupby('level', sort=False):
+        if level == 'practice':
+            continue
+        group = group.drop(columns='level').rename(columns={'unit': level})
+        name = f'by_{level}'
+        if level == NATIONAL:
+            group, name = group.drop(columns=level), NATIONAL
+        columns = [c for c in group.columns if c != 'date'] + ['date']
+        output_file = os.path.join(output_dir, f'measure_{measure_id}_{name}.csv')
+        group[columns].to_csv(output_file, index=False)
+        outputs.append(output_file)
+    return outputs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Roll a practice-level measure up to STP, region and national totals')
+    parser.add_argument('--study-definition', default='study_definition_measures_sro')
+    parser.add_argument('--measure-id', default='1_practice_only')
+    parser.add_argument('--output-dir', default=os.path.join('output', 'measures'))
+    parser.add_argument('--input-dir',
+                        help='read the cohort files, or their columnar dataset, from here '
+                             '(default: --output-dir)')
+    parser.add_argument('--levels', nargs='+', default=GEOGRAPHY)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    measure = {m.id: m for m in load_measures(args.study_definition)}[args.measure_id]
+    if measure.group_by != ('practice',):
+        parser.error(f'{measure.id} is not grouped by practice alone')
+    dimension = practice_dimension(list_inputs(args.input_dir or args.output_dir, args.study_definition),
+                                   args.levels, args.workers)
+    df = pd.read_csv(os.path.join(args.output_dir, f'measure_{measure.id}.csv'))
+    result = rollup(df, dimension, measure.numerator, measure.denominator, args.levels)
+    write_rollup(result, args.output_dir, measure.id)
@@ -0,0 +1,176 @@
+import argparse
+import importlib
+import json
+import os
+import warnings
+from collections import namedtuple
+from functools import lru_cache
+
+import pandas as pd
+
+
+SCHEMA_DIR = os.path.join('output', 'schema')
+
+# counts of events or episodes in a period, and ages, fit in Int16; other
+# integers (e.g. practice pseudo-ids) get Int32. Integer columns are pandas'
+# nullable types, as cells can be blank (e.g. dummy data with an incidence)
+SMALL_INT_RETURNING = {'number_of_matches_in_period', 'number_of_episodes'}
+SMALL_INT_FUNCTIONS = {'age_as_of'}
+ID_COLUMN = 'patient_id'
+
+# `dtype` maps columns to read_csv dtypes, `parse_dates` lists date columns
+# and `levels` holds the categories each categorical column is declared with
+Schema = namedtuple('Schema', ['dtype', 'parse_dates', 'levels'])
+# no declared dtypes: numbers are inferred, measure keys are read as text
+INFERRED = Schema({}, [], {})
+
+
+def _declared_levels(funcname, kwargs):
+    if funcname == 'categorised_as':
+        return [str(c) for c in kwargs['categories']]
+    ratios = ((kwargs.get('return_expectations') or {}).get('category') or {}).get('ratios')
+    return [str(c) for c in ratios] if ratios else []
+
+
+def schema_from_definitions(covariate_definitions):
+    """Derives a Schema from the `covariate_definitions` of a StudyDefinition,
+    following the column types cohortextractor gives each variable: Int8 for
+    flags, Int16 for counts and ages, Int32 for other integers (such as
+    practice pseudo-ids), categories for text and parsed dates.
+    """
+    dtype = {ID_COLUMN: 'int64'}
+    parse_dates = []
+    levels = {}
+    for name, (funcname, kwargs) in covariate_definitions.items():
+        if name == 'population' or kwargs.get('hidden'):
+            continue
+        column_type = kwargs['column_type']
+        # as cohortextractor: IMD and rural/urban come rounded or coded and
+        # are treated as categories, as are dates from categorised_as
+        if kwargs.get('returning') in ('index_of_multiple_deprivation', 'rural_urban_classification'):
+            column_type = 'str'
+        if funcname == 'categorised_as' and column_type == 'date':
+            column_type = 'str'
+
+        if column_type == 'bool':
+            dtype[name] = 'Int8'
+        elif column_type == 'int':
+            small = kwargs.get('returning') in SMALL_INT_RETURNING or funcname in SMALL_INT_FUNCTIONS
+            dtype[name] = 'Int16' if small else 'Int32'
+        elif column_type == 'float':
+            dtype[name] = 'float64'
+        elif column_type == 'date':
+            parse_dates.append(name)
+        elif column_type == 'str':
+            dtype[name] = 'category'
+            levels[name] = _declared_levels(funcname, kwargs)
+        else:
+            raise ValueError(f'Unable to derive a dtype for {column_type} ({name}: {funcname})')
+    return Schema(dtype, parse_dates, levels)
+
+
+@lru_cache(maxsize=None)
+def derive_schema(study_name):
+    """Imports the study definition `study_name` from analysis/ and derives
+    its Schema. Needs cohortextractor.
+    """
+    module = importlib.import_module(study_name)
+    return schema_from_definitions(module.study.covariate_definitions)
+
+
+def schema_path(study_name, schema_dir=SCHEMA_DIR):
+    return os.path.join(schema_dir, f'{study_name}.json')
+
+
+def save_schema(schema, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(schema._asdict(), f, indent=2)
+
+
+def load_schema(study_name, schema_dir=SCHEMA_DIR, required=True):
+    """The Schema of `study_name`: read from the json written by this
+    script's CLI when present, so loaders run without cohortextractor, and
+    derived from the study definition otherwise. If neither works (e.g.
+    without cohortextractor, or away from the repo root where the
+    codelists' relative paths do not resolve) and not `required`, warns and
+    returns INFERRED.
+    """
+    path = schema_path(study_name, schema_dir)
+    if os.path.exists(path):
+        with open(path) as f:
+            return Schema(**json.load(f))
+    if required:
+        return derive_schema(study_name)
+    try:
+        return derive_schema(study_name)
+    except (ImportError, OSError) as e:
+        warnings.warn(f'no schema for {study_name} in {schema_dir} and it cannot be derived '
+                      f'({e}); inferring dtypes')
+        return INFERRED
+
+
+def set_levels(df, schema):
+    """Orders the categories of each categorical column as declared, ahead of
+    any other values found in the data (e.g. real STP codes, or '' for
+    missing), so declared levels with no patients are kept and none are lost.
+    """
+    for c, declared in schema.levels.items():
+        if c in df.columns and declared:
+            found = [v for v in df[c].cat.categories if v not in set(declared)]
+            df[c] = df[c].cat.set_categories(declared + found)
+    return df
+
+
+def read_cohort(path, schema, columns=None):
+    """Reads a cohort file (csv, or parquet written by columnar.py) with the
+    dtypes of `schema`, optionally only `columns`. Blank cells are '' in
+    categories and missing everywhere else.
+    """
+    columns = list(columns) if columns is not None else None
+    selected = columns if columns is not None else list(schema.dtype) + schema.parse_dates
+    dtype = {c: t for c, t in schema.dtype.items() if c in selected}
+    parse_dates = [c for c in schema.parse_dates if c in selected]
+    if path.endswith('.parquet'):
+        from columnar import read_columns
+        df = read_columns(path, columns, dtype)
+        for c in parse_dates:
+            # parsed from text, whether stored as text or date32, as read_csv does
+            df[c] = pd.to_datetime(df[c].astype('string').replace('', None))
+    else:
+        header = list(pd.read_csv(path, nrows=0).columns) if columns is None else columns
+        blank = [c for c in header if dtype.get(c) != 'category']
+        df = pd.read_csv(path, usecols=columns, dtype=dtype, parse_dates=parse_dates,
+                         keep_default_na=False, na_values={c: [''] for c in blank})
+    return set_levels(df, schema)
+
+
+def read_measure(path, schema):
+    """Reads a `measure_<id>.csv` file of generate_measures: its group_by
+    columns (those before the numerator, denominator, value and date) with
+    the dtypes of `schema`, the counts and value as floats and the date
+    parsed.
+    """
+    header = list(pd.read_csv(path, nrows=0).columns)
+    keys = header[:-4] if header[-2:] == ['value', 'date'] else []
+    dtype = {c: schema.dtype.get(c, 'category') for c in keys}
+    dtype.update({c: 'float64' for c in header if c not in dtype and c != 'date'})
+    text = [c for c in keys if dtype[c] == 'category']
+    df = pd.read_csv(path, dtype=dtype, parse_dates=['date'] if 'date' in header else False,
+                     keep_default_na=False, na_values={c: [''] for c in header if c not in text})
+    return set_levels(df, schema)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Write the column dtypes of study definitions, for typed loading of their outputs')
+    parser.add_argument('--study-definitions', nargs='+', default=[
+        'study_definition_measures_bycode', 'study_definition_measures_weekly',
+        'study_definition_measures_sro', 'study_definition_ori', 'study_definition_v2',
+        'study_definition_practice_count',
+    ])
+    parser.add_argument('--output-dir', default=SCHEMA_DIR)
+    args = parser.parse_args()
+
+    for study_name in args.study_definitions:
+        save_schema(derive_schema(study_name), schema_path(study_name, args.output_dir))
@@ -0,0 +1,99 @@
+# Patient attributes that do not change with the index date, extracted once
+# for the whole study span and joined to every period by patient_snapshot.py
+
+# Import functions
+
+from cohortextractor import (
+    StudyDefinition,
+    patients,
+    codelist,
+    codelist_from_csv,
+    combine_codelists,
+    Measure
+)
+
+import pandas as pd
+
+# Import codelists
+from codelists import *
+
+# Specifiy study definition
+start_date = "2019-01-01"
+end_date = "2021-03-28"
+
+# every index date of the monthly and weekly runs over the span: anyone
+# registered on one of them is in some period's population, which
+# RegistrationIndex then picks out date by date
+index_dates = sorted(set(
+    pd.date_range(start_date, end_date, freq="MS").strftime("%Y-%m-%d")
+).union(pd.date_range(start_date, end_date, freq="W-MON").strftime("%Y-%m-%d")))
+registered_on = {
+    f"registered_{date.replace('-', '_')}": patients.registered_as_of(date)
+    for date in index_dates
+}
+
+study = StudyDefinition(
+    # Configure the expectations framework
+
+    index_date = start_date,
+    default_expectations={
+        "date": {"earliest": start_date, "latest": end_date},
+        "rate": "exponential_increase",
+        "incidence":1
+    },
+
+
+    # Study population: registered on any index date of the span, not just
+    # its first and last, so that patients who join and leave within it
+    # are kept
+    population = patients.satisfying(
+        " OR ".join(registered_on),
+        **registered_on,
+    ),
+
+    #### Sociodemographics : date of birth ; sex ; imd ; ethnicity ; death
+    date_of_birth=patients.date_of_birth(
+        "YYYY-MM",
+        return_expectations={
+            "date": {"earliest": "1920-01-01", "latest": "2019-12-31"},
+            "rate": "uniform",
+            "incidence": 1,
+        },
+    ),
+
+    sex=patients.sex(
+        return_expectations={
+            "rate": "universal",
+            "category": {"ratios": {"M": 0.49, "F": 0.5, "U": 0.01}},
+        }
+    ),
+
+    # Ethnicity (6 categories), latest recorded
+    ethnicity=patients.with_these_clinical_events(
+        ethnicity_codes,
+        returning="category",
+        find_last_match_in_period=True,
+        return_expectations={
+            "category": {"ratios": {"1": 0.2, "2":0.2, "3":0.2, "4":0.2, "5": 0.2}},
+            "incidence": 0.75,
+        },
+    ),
+
+    # IMD rank, banded locally
+    index_of_multiple_deprivation=patients.address_as_of(
+        start_date,
+        returning="index_of_multiple_deprivation",
+        round_to_nearest=100,
+        return_expectations={
+            "rate": "universal",
+            "category": {"ratios": {"100": 0.1, "5000": 0.2, "12000": 0.3, "20000": 0.2, "30000": 0.2}},
+        },
+    ),
+
+    date_of_death=patients.died_from_any_cause(
+        on_or_before=end_date,
+        returning="date_of_death",
+        date_format="YYYY-MM-DD",
+        return_expectations={"incidence": 0.02},
+    ),
+)
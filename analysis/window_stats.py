@@ -0,0 +1,93 @@
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from registration import patient_date_key
+
+
+# rows dated after `start` and on or before `end`; None leaves that side open
+Window = namedtuple('Window', ['name', 'start', 'end'])
+
+
+def whole_period(name='total'):
+    return Window(name, None, None)
+
+
+def trailing(months, end_date, name=None):
+    """The `months` before `end_date`: rows dated after end_date minus
+    `months`, with no upper bound, as the notebook's year and 3-month
+    counts.
+    """
+    start = pd.Timestamp(end_date) - pd.DateOffset(months=months)
+    return Window(name or f'months_{months}', start.strftime('%Y-%m-%d'), None)
+
+
+def standard_windows(end_date):
+    """Whole period, last year and last 3 months, as reported in the notebook.
+    """
+    return [whole_period('total'), trailing(12, end_date, 'year'), trailing(3, end_date, 'months_3')]
+
+
+def _day(date):
+    return None if date is None else np.datetime64(pd.Timestamp(date).date(), 'D')
+
+
+def window_statistics(df, windows, events_column=None, num_practices=None,
+                      practice_column='practice', date_column='date'):
+    """Distinct practices and (with `events_column`) summed events for every
+    window, from one sort of the rows by practice and date.
+
+    Practices count in a window when they have any row in it: for windows
+    with no end that is a last-active date after the start, found with one
+    searchsorted over the sorted last-active dates; for bounded windows it
+    is a searchsorted into each practice's run of dates. Event sums are
+    differences of a cumulative sum over the rows sorted by date.
+
+    Returns a tidy table with one row per window: window, start, end,
+    practices and practices_percent (of `num_practices`, when given), and
+    events and events_percent (of all events).
+    """
+    row_days = pd.to_datetime(df[date_column]).to_numpy().astype('datetime64[D]')
+    codes, practices = pd.factorize(df[practice_column], sort=True)
+    order = np.lexsort((row_days, codes))
+    codes, days = codes[order], row_days[order]
+    key = patient_date_key(codes, days)
+    ends = np.searchsorted(codes, np.arange(len(practices)), 'right')
+    last_active = np.sort(days[ends - 1]) if len(days) else days
+
+    if events_column is not None:
+        # integer counts stay integer, as their .sum() would
+        values = df[events_column]
+        if pd.api.types.is_integer_dtype(values) and not values.isna().any():
+            events = values.to_numpy(dtype=np.int64)
+        else:
+            events = np.nan_to_num(values.to_numpy(dtype=float))
+        by_date = np.argsort(row_days, kind='stable')
+        sorted_days = row_days[by_date]
+        cumulative = np.concatenate(([0], np.cumsum(events[by_date])))
+        total_events = cumulative[-1]
+
+    rows = []
+    for window in windows:
+        start, end = _day(window.start), _day(window.end)
+        if end is None:
+            n = len(last_active) if start is None else \
+                len(last_active) - np.searchsorted(last_active, start, 'right')
+        else:
+            # first row of each practice dated after the start
+            first = np.datetime64('1800-01-01') if start is None else start
+            pos = np.searchsorted(key, patient_date_key(np.arange(len(practices)), first), 'right')
+            safe = np.minimum(pos, len(key) - 1)
+            n = np.count_nonzero((pos < len(key)) & (codes[safe] == np.arange(len(practices)))
+                                 & (days[safe] <= end))
+        row = {'window': window.name, 'start': window.start, 'end': window.end, 'practices': int(n)}
+        if num_practices is not None:
+            row['practices_percent'] = float(f'{(n / num_practices) * 100:.2f}')
+        if events_column is not None:
+            lo = 0 if start is None else np.searchsorted(sorted_days, start, 'right')
+            hi = len(sorted_days) if end is None else np.searchsorted(sorted_days, end, 'right')
+            row['events'] = cumulative[hi] - cumulative[lo]
+            row['events_percent'] = float(f'{(row["events"] / total_events) * 100:.2f}') if total_events else np.nan
+        rows.append(row)
+    return pd.DataFrame(rows)
@@ -6,46 +6,194 @@ import json
 import datetime
 from dateutil.relativedelta import relativedelta
 import os
+import sys
+import warnings
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'analysis'))
+from patient_counts import (
+    STORE_DIR,
+    MANIFEST,
+    load_patient_ids,
+    load_sketches,
+    LastSeenIndex,
+    hll_merge,
+    hll_estimate,
+)
+from patient_activity import ActivityMatrix
+from quantile_sketch import digest_percentiles
+from disclosure import redact
+from schema import SCHEMA_DIR, load_schema, read_cohort, read_measure
+from denominators import DENOMINATOR_DIR, join_population, read_denominators
+from measure_cube import CUBE_DIR, MeasureCube
+from window_stats import standard_windows, window_statistics
+
+
+def _period_array(df, period_column, columns):
+    """Packs `columns` into a dense (column, period, row) float array, padded
+    with NaN, with one slot per row of each period. Returns the sorted
+    periods and the array.
+    """
+    df = df[df[period_column].notna()]
+    codes, periods = pd.factorize(df[period_column], sort=True)
+    order = np.argsort(codes, kind='stable')
+    codes = codes[order]
+    counts = np.bincount(codes, minlength=len(periods))
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    position = np.arange(len(codes)) - starts[codes]
+
+    values = np.full((len(columns), len(periods), counts.max(initial=0)), np.nan)
+    for i, c in enumerate(columns):
+        values[i, codes, position] = df[c].to_numpy(dtype=float)[order]
+    return periods, values
+
+
+def _weighted_quantiles(values, weights, quantiles):
+    """Weighted quantiles along the last axis of `values`, one sort and
+    cumulative sum for all rows. Each value sits at cumulative weight
+    (S_i - w_i/2 - w_0/2) / (S_n - w_0/2 - w_n/2), which reduces to the
+    linear interpolation used by `np.quantile` when all weights are equal.
+    Values that are missing or have no positive weight are ignored.
+    Returns an array of shape (len(quantiles),) + values.shape[:-1].
+    """
+    shape = values.shape[:-1]
+    values = values.reshape(-1, values.shape[-1])
+    weights = np.broadcast_to(weights, shape + weights.shape[-1:]).reshape(values.shape)
+    valid = ~np.isnan(values) & (weights > 0)
+    values = np.where(valid, values, np.nan)
+
+    order = np.argsort(values, axis=1)  # missing values sort last
+    values = np.take_along_axis(values, order, axis=1)
+    weights = np.where(valid, weights, 0)
+    weights = np.take_along_axis(weights, order, axis=1)
+    n_valid = valid.sum(axis=1)
+    rows = np.arange(len(values))
+    last = np.maximum(n_valid - 1, 0)
+
+    cumulative = np.cumsum(weights, axis=1)
+    first_w = weights[:, 0]
+    last_w = weights[rows, last]
+    span = cumulative[rows, last] - first_w / 2 - last_w / 2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        position = (cumulative - weights / 2 - first_w[:, None] / 2) / span[:, None]
+    # rows with a single value put it at 0; padding goes after 1
+    position = np.where(n_valid[:, None] == 1, 0, position)
+    position = np.where(np.isnan(values), 2, position)
+
+    # offset each row so one searchsorted covers them all
+    offset = 3 * rows[:, None]
+    flat = (position + offset).ravel()
+    target = np.asarray(quantiles)[None, :] + offset
+    hi = np.searchsorted(flat, target.ravel()).reshape(target.shape) - values.shape[1] * rows[:, None]
+    hi = np.clip(hi, 0, last[:, None])
+    lo = np.clip(hi - 1, 0, last[:, None])
+
+    p_lo = np.take_along_axis(position, lo, axis=1)
+    p_hi = np.take_along_axis(position, hi, axis=1)
+    v_lo = np.take_along_axis(values, lo, axis=1)
+    v_hi = np.take_along_axis(values, hi, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        frac = np.where(p_hi > p_lo, (target - offset - p_lo) / (p_hi - p_lo), 0)
+    result = v_lo + np.clip(frac, 0, 1) * (v_hi - v_lo)
+    result[n_valid == 0] = np.nan
+    return result.T.reshape((len(quantiles),) + shape)
+
+
+def _quantiles(show_outer_percentiles=True):
+    deciles = np.arange(0.1, 1, 0.1)
+    bottom_percentiles = np.arange(0.01, 0.1, 0.01)
+    top_percentiles = np.arange(0.91, 1, 0.01)
+    if show_outer_percentiles:
+        return np.concatenate((deciles, bottom_percentiles, top_percentiles))
+    return deciles
+
 
 # https://github.com/ebmdatalab/datalab-pandas/blob/master/ebmdatalab/charts.py#L20
-def add_percentiles(df, period_column=None, column=None, show_outer_percentiles=True):
+def add_percentiles(df, period_column=None, column=None, show_outer_percentiles=True, weights=None):
     """For each period in `period_column`, compute percentiles across that
     range.
     Adds `percentile` column.
+
+    The values are packed once into a dense period x row array and every
+    percentile of every period is taken in a single `nanquantile` pass.
+    `column` may be a list, giving one output column per value column.
+
+    Pass a column name as `weights` (e.g. "population") for weighted
+    percentiles, so that each practice counts in proportion to its list size.
     """
-    deciles = np.arange(0.1, 1, 0.1)
-    bottom_percentiles = np.arange(0.01, 0.1, 0.01)
-    top_percentiles = np.arange(0.91, 1, 0.01)
-    if show_outer_percentiles:
-        quantiles = np.concatenate((deciles, bottom_percentiles, top_percentiles))
+    quantiles = _quantiles(show_outer_percentiles)
+    columns = [column] if isinstance(column, str) else list(column)
+
+    if weights is not None:
+        periods, values = _period_array(df, period_column, columns + [weights])
+        result = _weighted_quantiles(values[:-1], values[-1], quantiles)
     else:
-        quantiles = deciles
-    df = df.groupby(period_column)[column].quantile(quantiles).reset_index()
-    df = df.rename(index=str, columns={"level_1": "percentile"})
-    # create integer range of percentiles
-    df["percentile"] = df["percentile"].apply(lambda x: int(x * 100))
+        periods, values = _period_array(df, period_column, columns)
+        with warnings.catch_warnings():
+            # periods where every value is missing give NaN, as groupby does
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            result = np.nanquantile(values, quantiles, axis=2)
+
+    out = pd.DataFrame({
+        period_column: np.repeat(periods, len(quantiles)),
+        # create integer range of percentiles
+        "percentile": np.tile(np.rint(quantiles * 100).astype(int), len(periods)),
+    })
+    for i, c in enumerate(columns):
+        out[c] = result[:, i, :].T.ravel()
+    return out
+
+
+def add_percentiles_from_digests(digests, period_column='date', column='value', show_outer_percentiles=True):
+    """As `add_percentiles`, but estimated from per-period t-digests (see
+    `analysis/quantile_sketch.py`) rather than the full practice-level table.
+    """
+    df = digest_percentiles(digests, _quantiles(show_outer_percentiles), period_column, column)
+    df[period_column] = pd.to_datetime(df[period_column])
     return df
 
 
+def compare_percentiles(exact, approx, period_column='date', column='value'):
+    """Accuracy of approximate percentiles against exact `add_percentiles`
+    output: absolute error per percentile, summarised over periods.
+    """
+    exact = exact.assign(**{period_column: pd.to_datetime(exact[period_column])})
+    approx = approx.assign(**{period_column: pd.to_datetime(approx[period_column])})
+    df = exact.merge(approx, on=[period_column, "percentile"], suffixes=("_exact", "_approx"))
+    df['abs_error'] = (df[f'{column}_approx'] - df[f'{column}_exact']).abs()
+    return df.groupby("percentile")['abs_error'].agg(['mean', 'max']).reset_index()
+
+
 def to_datetime_sort(df):
     df['date'] = pd.to_datetime(df['date'])
     df = df.sort_values(by='date')
 
 
-def redact_small_numbers(df, n, m):
+def redact_small_numbers(df, n, m, secondary=True, round_to=None):
     """
-    Takes measures df and converts any row to nana where value of denominator or numerater in measure m equal to 
-    or below n
-    Returns df of same shape.
+    Takes measures df and redacts the numerator and denominator of measure m
+    where they are between 1 and n, plus the next smallest count in the same
+    date when the redacted cells still sum to n or less. `value` is redacted
+    wherever either count is; other cells are left as they are.
+    Redacts df in place, as before, and returns it.
     """
-    mask_n = df[m.numerator].isin(list(range(0, n+1)))
-    mask_d = df[m.denominator].isin(list(range(0, n+1)))
-    mask = mask_n | mask_d
-    df.loc[mask, :] = np.nan
+    rates = {"value": (m.numerator, m.denominator)} if "value" in df.columns else None
+    block_by = ["date"] if "date" in df.columns else None
+    redacted = redact(df, [m.numerator, m.denominator], threshold=n, block_by=block_by,
+                      secondary=secondary, round_to=round_to, rates=rates)
+    for c in redacted.columns:
+        df[c] = redacted[c]
     return df
 
 
-def calculate_rate(df, value_col='had_smr', population_col='population', rate_per=1000):
+def calculate_rate(df, value_col='had_smr', population_col='population', rate_per=1000, denominators=None, keys=None):
+    """Adds `rate` per `rate_per` of `population_col`.
+
+    Pass the denominator store (`read_denominators()`) and the `keys` of
+    `df` (e.g. ["date", "practice"]) to take the population from the store
+    instead of from `df`.
+    """
+    if denominators is not None:
+        df[population_col] = join_population(df, denominators, keys, population_col)[population_col].to_numpy()
     num_per_thousand = df[value_col]/(df[population_col]/rate_per)
     df['rate'] = num_per_thousand
 
@@ -143,7 +291,14 @@ def plot_measures(df, title, measure_id, column_to_plot, category=False, y_label
 
 
 
-def drop_irrelevant_practices(df):
+def drop_irrelevant_practices(df, cube=None, measure_id=None):
+    """Drops practices that never use the code. With a `cube` (see
+    `load_measure_cube`) the practices to keep are read from its
+    `measure_id` slice instead of being recomputed from `df`.
+    """
+    if cube is not None:
+        return df[df['practice'].isin(cube.relevant_practices(measure_id))]
+
     #drop practices that do not use the code
     mean_value_df = df.groupby("practice")["value"].mean().reset_index()
 
@@ -212,103 +367,125 @@ def create_child_table(df, code_df, code_column, term_column, measure, nrows=5):
     return df.iloc[:nrows, :]
 
 
-def get_patients_counts(df, event_column, end_date):
-    f = open("output/patient_count.json")
-    num_patients = json.load(f)['num_patients']
-    dates = list(num_patients.keys())
-
-    dates = sorted(dates)
-
-    def get_counts_from_dates_list(dates):
-        patients = np.concatenate([num_patients[date] for date in dates])
-        patients_total = len(np.unique(patients))
-        return patients_total
+def load_cohort(path, study_name, columns=None, schema_dir=SCHEMA_DIR):
+    """Reads a cohort file with the dtypes its study definition declares,
+    rather than letting pandas infer them (as it does, with a warning, when
+    there is no schema json and the study definition cannot be imported).
+    """
+    return read_cohort(path, load_schema(study_name, schema_dir, required=False), columns)
 
-    patients_total = get_counts_from_dates_list(dates)
 
-    end_date = datetime.datetime.strptime(end_date, '%Y-%m-%d')
-    year_before = end_date - relativedelta(years=1)
-    dates_year = [i for i in dates if datetime.datetime.strptime(
-        i, '%Y-%m-%d') > year_before]
-    patients_year = get_counts_from_dates_list(dates_year)
+def load_measure(path, study_name, schema_dir=SCHEMA_DIR):
+    """Reads a measure file with the group_by dtypes its study definition
+    declares, rather than letting pandas infer them; without a schema the
+    group_by columns are read as text.
+    """
+    return read_measure(path, load_schema(study_name, schema_dir, required=False))
 
-    months_3_before = end_date - relativedelta(months=3)
-    dates_months_3 = [i for i in dates if datetime.datetime.strptime(
-        i, '%Y-%m-%d') > months_3_before]
-    patients_months_3 = get_counts_from_dates_list(dates_months_3)
 
-    numbers_dict = {"total": patients_total,
-                    "year": patients_year, "months_3": patients_months_3}
-    return numbers_dict
-    
+def load_measure_cube(cube_dir=CUBE_DIR):
+    """Memory-mapped practice x period x measure cube written by
+    analysis/measure_cube.py.
+    """
+    return MeasureCube.load(cube_dir)
 
-def get_number_practices(df, end_date):
-    
-    num_practices_total = len(np.unique(df['practice']))
 
-    end_date = datetime.datetime.strptime(
-        end_date, '%Y-%m-%d')
+def load_denominators(store_dir=DENOMINATOR_DIR):
+    """Population per period, practice and stratum, from the denominator
+    store written by analysis/denominators.py.
+    """
+    return read_denominators(store_dir)
 
 
-    year_before = end_date - relativedelta(years=1)
-    months_3_before = end_date - relativedelta(months=3)
+def load_patient_counts(store_dir=STORE_DIR, json_path="output/patient_count.json"):
+    """Per-month patient ids, memory-mapped from the binary store written by
+    `SROtem_get_patients_counts.py --incremental` when present, otherwise
+    read from the json output.
+    """
+    if os.path.exists(os.path.join(store_dir, MANIFEST)):
+        return load_patient_ids(store_dir)
+    with open(json_path) as f:
+        return json.load(f)['num_patients']
 
-    df_subset_year = df[df['date'] > year_before]
-    num_practices_year = len(np.unique(df_subset_year['practice']))
 
-    df_subset_months_3 = df[df['date'] > months_3_before]
-    num_practices_months_3 = len(np.unique(df_subset_months_3['practice']))
+def load_activity_matrix(store_dir=STORE_DIR):
+    """Patient x month activity matrix for repeat-use and retention queries.
+    """
+    return ActivityMatrix.from_counts(load_patient_counts(store_dir))
 
-    numbers_dict = {"total": num_practices_total, "year": num_practices_year, "3_months": num_practices_months_3}
-    return numbers_dict
 
+def get_patients_counts_windows(end_date, months=(1, 3, 6, 12), store_dir=STORE_DIR):
+    """Exact distinct patients over the whole period and every trailing
+    window of `months` before `end_date`, in one call.
+    Returns {"total": n, "months_<k>": n, ...}.
+    """
+    index = LastSeenIndex(load_patient_counts(store_dir))
+    return index.trailing_counts(end_date, months)
 
-def get_number_events(df, events_column, end_date):
 
-    end_date = datetime.datetime.strptime(
-        end_date, '%Y-%m-%d')
+def get_patients_counts(df, event_column, end_date, mode="exact", store_dir=STORE_DIR):
+    """Distinct patients with an event over the whole period, the last year
+    and the last 3 months.
 
-    year_before = end_date - relativedelta(years=1)
-    months_3_before = end_date - relativedelta(months=3)
+    mode="exact" answers every window from a last-seen index of the per-month
+    ids. mode="sketch" merges the per-month HyperLogLog sketches kept in the
+    binary store instead; counts are then approximate, with a relative
+    standard error of about 1.6% (`patient_counts.hll_error()`).
+    """
+    if mode == "exact":
+        counts = get_patients_counts_windows(end_date, (12, 3), store_dir)
+        return {"total": counts["total"],
+                "year": counts["months_12"], "months_3": counts["months_3"]}
+
+    if mode != "sketch":
+        raise ValueError(f"unknown mode {mode!r}, expected 'exact' or 'sketch'")
+
+    if not os.path.exists(os.path.join(store_dir, MANIFEST)):
+        raise ValueError(
+            f"sketch mode needs the binary store in {store_dir}; "
+            "run SROtem_get_patients_counts.py --incremental")
+    sketches = load_sketches(store_dir)
+    dates = sorted(sketches)
+    periods = np.array(dates, dtype='datetime64[D]')
 
-    num_events_total = df[events_column].sum()
+    def get_counts_from_dates_list(dates):
+        if not dates:
+            return 0
+        return hll_estimate(hll_merge([sketches[date] for date in dates]))
 
-    df_subset_year = df[df['date'] > year_before]
-    num_events_year = df_subset_year[events_column].sum()
+    end_date = datetime.datetime.strptime(end_date, '%Y-%m-%d')
+    year_before = np.datetime64((end_date - relativedelta(years=1)).date())
+    months_3_before = np.datetime64((end_date - relativedelta(months=3)).date())
 
-    df_subset_months_3 = df[df['date'] > months_3_before]
-    num_events_months_3 = df_subset_months_3[events_column].sum()
+    dates_year = [d for d, period in zip(dates, periods) if period > year_before]
+    dates_months_3 = [d for d, period in zip(dates, periods) if period > months_3_before]
 
-    numbers_dict = {"total": num_events_total,
-                    "year": num_events_year, "months_3": num_events_months_3}
+    numbers_dict = {"total": get_counts_from_dates_list(dates),
+                    "year": get_counts_from_dates_list(dates_year),
+                    "months_3": get_counts_from_dates_list(dates_months_3)}
     return numbers_dict
-
-
-def calculate_statistics_practices(df, practice_df, end_date):
-
     
-    num_practices = len(np.unique(practice_df['practice']))
 
-
-    # calculate number of unique practices and caluclate as % of total
-    practices_included_total = get_number_practices(df, end_date)['total']
-    practices_included_year = get_number_practices(df, end_date)['year']
-    practices_included_months_3 = get_number_practices(df, end_date)['3_months']
+def get_number_practices(df, end_date):
+    stats = window_statistics(df, standard_windows(end_date)).set_index('window')['practices']
+    return {"total": stats['total'], "year": stats['year'], "3_months": stats['months_3']}
 
 
-    practices_included_percent_total = float(
-        f'{((practices_included_total/num_practices)*100):.2f}')
-    
-    practices_included_percent_year = float(
-        f'{((practices_included_year/num_practices)*100):.2f}')
+def get_number_events(df, events_column, end_date):
+    stats = window_statistics(df, standard_windows(end_date), events_column).set_index('window')['events']
+    return {"total": stats['total'], "year": stats['year'], "months_3": stats['months_3']}
 
-    practices_included_percent_months_3 = float(
-        f'{((practices_included_months_3/num_practices)*100):.2f}')
 
+def calculate_statistics_practices(df, practice_df, end_date):
+    """Practices with data over the whole period, the last year and the last
+    3 months, and as % of all practices in `practice_df`, from a single
+    `window_statistics` pass.
+    """
+    num_practices = len(np.unique(practice_df['practice']))
+    stats = window_statistics(df, standard_windows(end_date), num_practices=num_practices).set_index('window')
 
-    return {"total": {"number": practices_included_total, "percent": practices_included_percent_total}, "year": {"number": practices_included_year, "percent": practices_included_percent_year}, "months_3": {"number": practices_included_months_3, "percent": practices_included_percent_months_3}}
-    
-    practices_included_total, practices_included_percent_total, practices_included_months_3, practices_included_percent_months_3
+    return {window: {"number": stats.loc[window, 'practices'], "percent": stats.loc[window, 'practices_percent']}
+            for window in ("total", "year", "months_3")}
 
 
 def calculate_statistics_demographics(df, demographic_var, end_date, event_column):
@@ -343,17 +520,36 @@ def interactive_deciles_chart(
     period_column=None,
     column=None,
     title="",
-    ylabel=""
+    ylabel="",
+    digests=None,
+    weights=None,
+    denominators=None
 ):
     """period_column must be dates / datetimes
-    """
 
-    df = add_percentiles(
-        df,
-        period_column=period_column,
-        column=column,
-        show_outer_percentiles=False,
-    )
+    Pass `digests` ({period: TDigest}) instead of `df` to chart deciles
+    estimated from stored sketches, or a `weights` column for weighted deciles.
+    With `denominators` (the denominator store), practice list sizes for
+    `weights` are joined from it by period and practice.
+    """
+    if denominators is not None and weights is not None:
+        df = join_population(df, denominators, [period_column, 'practice'], weights)
+
+    if digests is not None:
+        df = add_percentiles_from_digests(
+            digests,
+            period_column=period_column,
+            column=column,
+            show_outer_percentiles=False,
+        )
+    else:
+        df = add_percentiles(
+            df,
+            period_column=period_column,
+            column=column,
+            show_outer_percentiles=False,
+            weights=weights,
+        )
 
     fig = go.Figure()
 
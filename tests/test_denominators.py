@@ -0,0 +1,70 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'analysis'))
+from denominators import join_population, read_denominators, update_denominators
+from measures_engine import MeasureSpec, calculate_measures, generate_measures, list_inputs
+from test_measures_engine import write_inputs
+
+
+STUDY = 'study_definition_test'
+MEASURES = [
+    MeasureSpec('total', 'event_x', 'population', ('population',)),
+    MeasureSpec('by_practice', 'event_x', 'population', ('practice',)),
+    MeasureSpec('by_sex', 'event_x', 'population', ('sex',)),
+]
+
+
+def build(tmp_path):
+    output_dir, store_dir = tmp_path / 'output', tmp_path / 'store'
+    output_dir.mkdir()
+    write_inputs(output_dir)
+    update_denominators(list_inputs(str(output_dir), STUDY), str(store_dir), study_name=STUDY)
+    return str(output_dir), str(store_dir)
+
+
+def test_measures_from_the_store_match_counted_measures(tmp_path):
+    output_dir, store_dir = build(tmp_path)
+    counted = {m.id: pd.read_csv(path) for m, path in
+               zip(MEASURES, generate_measures(STUDY, output_dir, measures=MEASURES))}
+    generate_measures(STUDY, output_dir, measures=MEASURES, denominator_dir=store_dir)
+    for m in MEASURES:
+        stored = pd.read_csv(os.path.join(output_dir, f'measure_{m.id}.csv'))
+        pd.testing.assert_frame_equal(stored, counted[m.id], check_dtype=False)
+
+
+def test_store_of_other_inputs_or_study_is_refused(tmp_path):
+    output_dir, store_dir = build(tmp_path)
+    with pytest.raises(ValueError, match='is for study_definition_test'):
+        generate_measures('study_definition_other', output_dir, measures=MEASURES, denominator_dir=store_dir)
+
+    path = list_inputs(output_dir, STUDY)['2019-02-01']
+    df = pd.read_csv(path)
+    df.loc[0, 'practice'] = 99
+    df.to_csv(path, index=False)
+    with pytest.raises(ValueError, match=r"out of date for \['2019-02-01'\]"):
+        generate_measures(STUDY, output_dir, measures=MEASURES, denominator_dir=store_dir)
+
+
+def test_groups_missing_from_the_store_raise():
+    df = pd.DataFrame({'practice': pd.Categorical(['1', '2', '3']), 'event_x': [1.0, 0.0, 2.0],
+                       'population': 1})
+    denominators = pd.DataFrame({'practice': pd.Categorical(['1', '2']), 'population': [10, 20]})
+    with pytest.raises(ValueError, match='not in the denominator store'):
+        calculate_measures(df, MEASURES[1:2], denominators)
+
+
+def test_population_is_nan_for_keys_not_in_the_store():
+    denominators = pd.DataFrame({'practice': ['1', '2'], 'population': [10, 20]})
+    df = join_population(pd.DataFrame({'practice': [1, 3]}), denominators, ['practice'])
+    assert df['population'].iloc[0] == 10
+    assert np.isnan(df['population'].iloc[1])
+
+
+def test_reading_an_empty_store_raises(tmp_path):
+    with pytest.raises(FileNotFoundError, match='no denominators'):
+        read_denominators(str(tmp_path))
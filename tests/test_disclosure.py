@@ -0,0 +1,91 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'analysis'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'notebooks'))
+from disclosure import redact, suppression_mask
+from measures_engine import MeasureSpec
+from utilities import redact_small_numbers
+
+
+def r_redactor(n, threshold):
+    # the R `redactor`, transcribed: redact 1..threshold, then if those sum
+    # to threshold or less, also the first smallest count among the rest
+    n = np.asarray(n, dtype=np.int64)
+    leq_threshold = (n >= 1) & (n <= threshold)
+    redact = leq_threshold.copy()
+    if (n * leq_threshold).sum() <= threshold and leq_threshold.any():
+        redact[np.argmin(np.where(leq_threshold, n.sum() + 1, n))] = True
+    return redact
+
+
+def test_suppression_mask_matches_r_redactor():
+    rng = np.random.default_rng(0)
+    for _ in range(3000):
+        size = rng.integers(1, 8)
+        n = rng.choice([0, 1, 2, 3, 4, 5, 6, 8, 10, 50], size)
+        threshold = int(rng.integers(1, 8))
+        mask = suppression_mask(n, np.zeros(size, dtype=np.int64), threshold)
+        assert mask.tolist() == r_redactor(n, threshold).tolist(), (n, threshold)
+
+
+def test_blocks_are_suppressed_independently():
+    rng = np.random.default_rng(1)
+    blocks = [rng.choice([0, 1, 3, 6, 9, 40], rng.integers(1, 6)) for _ in range(200)]
+    n = np.concatenate(blocks)
+    code = np.repeat(np.arange(len(blocks)), [len(b) for b in blocks])
+    # interleave the blocks round-robin, keeping the order within each
+    # (ties go to the first row, as in R)
+    position = np.concatenate([np.arange(len(b)) for b in blocks])
+    order = np.lexsort((code, position))
+    mask = np.empty(len(n), dtype=bool)
+    mask[order] = suppression_mask(n[order], code[order])
+    assert mask.tolist() == np.concatenate([r_redactor(b, 5) for b in blocks]).tolist()
+
+
+def test_redact_blocks_by_date():
+    df = pd.DataFrame({'date': ['2020-01-01'] * 3 + ['2020-02-01'] * 3,
+                       'practice': [1, 2, 3] * 2,
+                       'event': [3.0, 20.0, 30.0, 10.0, 20.0, 30.0]})
+    redacted = redact(df, ['event'], block_by=['date'])
+    # January: 3 and the next smallest (20); February: untouched
+    assert redacted['event'].isna().tolist() == [True, True, False, False, False, False]
+    # a copy: the input is left as it was
+    assert df['event'].notna().all()
+
+
+def test_rates_masked_with_either_count_and_recalculated_after_rounding():
+    df = pd.DataFrame({'event': [2.0, 12.0, 18.0, 26.0],
+                       'population': [100.0, 3.0, 40.0, 51.0]})
+    df['value'] = df['event'] / df['population']
+    redacted = redact(df, ['event', 'population'], secondary=False, round_to=5,
+                      rates={'value': ('event', 'population')})
+    assert redacted['event'].tolist()[2:] == [20.0, 25.0]
+    assert redacted['population'].tolist()[2:] == [40.0, 50.0]
+    # masked where the numerator (row 0) or the denominator (row 1) is
+    assert redacted['value'].isna().tolist() == [True, True, False, False]
+    assert redacted['value'].tolist()[2:] == [20.0 / 40.0, 25.0 / 50.0]
+
+
+def test_redact_small_numbers_in_place_and_keeps_zeros():
+    m = MeasureSpec('m', 'event', 'population', ('practice',))
+    df = pd.DataFrame({'date': ['2020-01-01'] * 4, 'practice': [1, 2, 3, 4],
+                       'event': [0.0, 4.0, 10.0, 20.0],
+                       'population': [100.0, 100.0, 100.0, 100.0]})
+    df['value'] = df['event'] / df['population']
+    result = redact_small_numbers(df, 5, m)
+    assert result is df
+    # the 4 and the next smallest count (the zero) are redacted; zeros alone
+    # are no longer a reason to redact, as the old whole-row blanking did
+    assert df['event'].isna().tolist() == [True, True, False, False]
+    assert df['population'].notna().all()
+    assert df['value'].isna().tolist() == [True, True, False, False]
+    assert df['practice'].tolist() == [1, 2, 3, 4]
+
+    df = pd.DataFrame({'date': ['2020-01-01'] * 2, 'practice': [1, 2],
+                       'event': [0.0, 30.0], 'population': [100.0, 100.0]})
+    redact_small_numbers(df, 5, m)
+    assert df['event'].tolist() == [0.0, 30.0]
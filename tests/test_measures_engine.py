@@ -0,0 +1,58 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'analysis'))
+from measures_engine import MeasureSpec, calculate_measures, generate_measures, load_input, update_measures
+
+
+MEASURES = [
+    MeasureSpec('total', 'event_x', 'population', ('population',)),
+    MeasureSpec('practice_only', 'event_x', 'population', ('practice',)),
+    MeasureSpec('by_sex', 'event_x', 'population', ('sex',)),
+]
+
+
+def write_inputs(output_dir, dates=('2019-01-01', '2019-02-01', '2019-03-01')):
+    rng = np.random.default_rng(0)
+    for date in dates:
+        n = 500
+        pd.DataFrame({
+            'patient_id': np.arange(n),
+            'practice': rng.integers(1, 20, n),
+            'sex': rng.choice(['F', 'M'], n),
+            'event_x': rng.integers(0, 3, n),
+        }).to_csv(os.path.join(output_dir, f'input_test_{date}.csv'), index=False)
+
+
+def read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_update_measures_matches_generate_measures_byte_for_byte(tmp_path):
+    full, incremental = tmp_path / 'full', tmp_path / 'incremental'
+    for output_dir in (full, incremental):
+        output_dir.mkdir()
+        write_inputs(output_dir)
+
+    generate_measures('study_definition_test', str(full), measures=MEASURES)
+    update_measures('study_definition_test', str(incremental), measures=MEASURES)
+
+    for m in MEASURES:
+        name = f'measure_{m.id}.csv'
+        assert b'\r\n' not in read_bytes(incremental / name)
+        assert read_bytes(incremental / name) == read_bytes(full / name)
+
+
+def test_blank_counts_are_missing_and_blank_groups_stay_labels(tmp_path):
+    path = tmp_path / 'input_test_2019-01-01.csv'
+    path.write_text('patient_id,practice,sex,event_x\n1,1,F,2\n2,1,,\n3,2,M,1\n')
+    measures = [MeasureSpec('by_sex', 'event_x', 'population', ('sex',))]
+    df = load_input(str(path), measures)
+    assert df['sex'].tolist() == ['F', '', 'M']
+    assert np.isnan(df['event_x'].iloc[1])
+    result = calculate_measures(df, measures)['by_sex']
+    assert result['event_x'].tolist() == [0.0, 2.0, 1.0]
@@ -0,0 +1,79 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'analysis'))
+import registration
+from registration import RegistrationIndex
+
+
+SPELLS = pd.DataFrame({
+    'patient_id': [1, 1, 2, 2, 3],
+    'start_date': pd.to_datetime(['2019-01-01', '2019-06-01', '2019-01-01', '2019-03-01', '2019-02-01']),
+    'end_date': pd.to_datetime([None, '2019-08-01', '2019-12-31', '2019-04-30', '2019-05-31']),
+    'practice': [10, 20, 30, 40, 50],
+})
+DATES = ['2018-12-01', '2019-03-15', '2019-07-01', '2019-09-01', '2020-01-01']
+
+
+def covering_practice(spells, patient_id, date):
+    # the latest starting spell that covers the date, by brute force
+    date = pd.Timestamp(date)
+    spells = spells[(spells['patient_id'] == patient_id) & (spells['start_date'] <= date)
+                    & (spells['end_date'].isna() | (spells['end_date'] >= date))]
+    return int(spells.sort_values('start_date')['practice'].iloc[-1]) if len(spells) else -1
+
+
+def test_ended_later_spell_does_not_hide_open_earlier_spell():
+    index = RegistrationIndex(SPELLS)
+    practice = index.practice_at(DATES, [1, 2, 3])
+    # patient 1 is still in the open 2019-01-01 spell after leaving practice 20
+    assert practice[0].tolist() == [-1, 10, 20, 10, 10]
+    # patient 2's later spell sits inside the earlier one
+    assert practice[1].tolist() == [-1, 40, 30, 30, -1]
+    assert practice[2].tolist() == [-1, 50, -1, -1, -1]
+
+
+def test_overlapping_spells_match_brute_force():
+    rng = np.random.default_rng(0)
+    n = 400
+    start = pd.Timestamp('2018-01-01') + pd.to_timedelta(rng.integers(0, 900, n), unit='D')
+    length = pd.to_timedelta(rng.integers(1, 400, n), unit='D')
+    spells = pd.DataFrame({
+        'patient_id': rng.integers(0, 60, n),
+        'start_date': start,
+        'end_date': (start + length).where(rng.random(n) > 0.2),
+        'practice': np.arange(n),
+    }).drop_duplicates(['patient_id', 'start_date'])
+    dates = pd.date_range('2018-01-01', '2021-06-01', freq='MS').strftime('%Y-%m-%d')
+    patients = np.arange(-1, 61)
+
+    index = RegistrationIndex(spells)
+    practice = index.practice_at(dates, patients)
+    expected = [[covering_practice(spells, p, d) for d in dates] for p in patients]
+    assert practice.tolist() == expected
+
+
+def test_registered_with_one_practice_between_uses_any_covering_spell():
+    index = RegistrationIndex(SPELLS)
+    assert index.registered_with_one_practice_between('2019-07-01', '2020-01-01', [1, 2, 3]).tolist() == \
+        [True, False, False]
+    assert index.registered_with_one_practice_between('2019-03-15', '2019-12-31', [1, 2, 3]).tolist() == \
+        [True, True, False]
+
+
+def test_chunked_queries_match_one_block(monkeypatch):
+    deaths = pd.DataFrame({'patient_id': [1], 'date_of_death': pd.to_datetime(['2019-08-15'])})
+    index = RegistrationIndex(SPELLS, deaths)
+    expected = (index.practice_at(DATES), index.registered_at(DATES), index.denominators(DATES))
+    monkeypatch.setattr(registration, 'PATIENT_CHUNK', 1)
+    assert np.array_equal(index.practice_at(DATES), expected[0])
+    assert np.array_equal(index.registered_at(DATES), expected[1])
+    pd.testing.assert_frame_equal(index.denominators(DATES), expected[2])
+    assert expected[2].to_dict('list') == {
+        'date': ['2019-03-15', '2019-03-15', '2019-03-15', '2019-07-01', '2019-07-01', '2019-09-01'],
+        'practice': [10, 40, 50, 20, 30, 30],
+        'population': [1, 1, 1, 1, 1, 1],
+    }
@@ -0,0 +1,30 @@
+import os
+import sys
+
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'analysis'))
+from schema import read_cohort, schema_from_definitions
+
+
+DEFINITIONS = {
+    'population': ('satisfying', {'column_type': 'bool'}),
+    'practice': ('registered_practice_as_of', {'column_type': 'int', 'returning': 'pseudo_id'}),
+    'age': ('age_as_of', {'column_type': 'int'}),
+    'event_x': ('with_these_clinical_events', {'column_type': 'bool'}),
+    'sex': ('sex', {'column_type': 'str', 'return_expectations': {'category': {'ratios': {'F': 0.5, 'M': 0.5}}}}),
+}
+
+
+def test_blank_integer_cells_are_missing(tmp_path):
+    schema = schema_from_definitions(DEFINITIONS)
+    assert schema.dtype['practice'] == 'Int32' and schema.dtype['event_x'] == 'Int8'
+    path = tmp_path / 'input_practice_count.csv'
+    path.write_text('patient_id,practice,age,event_x,sex\n1,,40,1,F\n2,7,,,\n')
+    df = read_cohort(str(path), schema)
+    assert df['practice'].isna().tolist() == [True, False]
+    assert df['practice'].iloc[1] == 7
+    assert df['age'].isna().tolist() == [False, True]
+    assert df['sex'].tolist() == ['F', '']
+    assert list(df['sex'].cat.categories) == ['F', 'M', '']
+    assert isinstance(df['event_x'].dtype, pd.Int8Dtype)